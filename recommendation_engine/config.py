@@ -44,7 +44,110 @@ class Settings(BaseSettings):
     SAMPLE_USER_SONG_INTERACTION_PATH: str
     SAMPLE_USER_FAV_ARTIST_PATH: str
     SAMPLE_USER_FAV_GENRES_PATH: str
+    # saved model directory (fp32), or the .pt written by scripts/saveEmbeddingModel.py --quantize (int8)
     EMBEDDINGS_MODEL: str
 
+    # "exact" scores every song, "ann" searches an IVF-flat index first
+    SEARCH_MODE: str = "exact"
+    ANN_INDEX_PATH: str = os.path.join(
+        os.path.dirname(__file__), "data", "index", "ivf_flat.npz"
+    )
+    # 0 means sqrt(number of songs)
+    ANN_N_LISTS: int = 0
+    # lists probed per query: higher means better recall and slower search
+    ANN_N_PROBE: int = 8
+    # songs kept from the ANN search before bonus scoring and the final top 40
+    ANN_SHORTLIST_SIZE: int = 400
+
+    # batch scoring tiles: peak memory is about BATCH_USER_TILE * BATCH_CATALOG_TILE floats
+    BATCH_USER_TILE: int = 256
+    BATCH_CATALOG_TILE: int = 16384
+    # limits of one /user/recommendSongsBatch request
+    BATCH_MAX_USERS: int = 1000
+    BATCH_MAX_TOP_K: int = 500
+
+    # threads that score requests, and how many requests may queue for them
+    SCORING_WORKERS: int = 4
+    SCORING_MAX_PENDING: int = 64
+    # embedding jobs run on their own pool so they do not compete with scoring
+    EMBEDDING_WORKERS: int = 1
+    EMBEDDING_MAX_PENDING: int = 256
+
+    # "none" scans the float32 matrix, "float16" or "int8" scan a quantized copy first
+    EMBEDDINGS_QUANTIZATION: str = "none"
+    # songs from the quantized scan that are rescored with the float32 embeddings
+    RESCORE_CANDIDATES: int = 400
+    # where the float32 matrix is memory mapped when quantized, empty keeps it in memory
+    EMBEDDINGS_SPILL_DIR: str = os.path.join(os.path.dirname(__file__), "data", "index")
+    # queries used to measure the recall of the quantized search at startup, 0 skips it
+    QUANTIZATION_RECALL_QUERIES: int = 20
+
+    # how new embeddings are written to songs_embeddings: "array" of doubles or packed float32 "binary"
+    EMBEDDINGS_FORMAT: str = "array"
+
+    # texts per encoder batch, texts are grouped by token length so batches carry little padding
+    ENCODE_BATCH_SIZE: int = 32
+    # processes that encode texts during /updateEmbeddingsDb, each loads its own model; 1 encodes in the server
+    ENCODE_WORKERS: int = 1
+    # torch threads of each of those processes, 0 = cores / ENCODE_WORKERS
+    ENCODE_THREADS_PER_WORKER: int = 0
+    # tokens kept per text, 0 keeps the model's own limit (changing it changes the vectors)
+    ENCODE_MAX_SEQ_LENGTH: int = 0
+
+    # SQLite cache of textual vectors keyed by a hash of the text and the model, empty disables it
+    EMBEDDING_CACHE_PATH: str = os.path.join(
+        os.path.dirname(__file__), "data", "cache", "text_embeddings.sqlite"
+    )
+    # about 1.5 KB per entry with a 384 dimensions model, least recently used entries go first
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 500000
+
+    # tracks EmbeddingsOps reads, encodes and writes at a time, memory grows with it and not with the catalog
+    EMBEDDINGS_CHUNK_SIZE: int = 1000
+
+    # embeddings snapshot written by EmbeddingsOps and memory mapped at startup, empty disables it
+    EMBEDDINGS_SNAPSHOT_DIR: str = os.path.join(
+        os.path.dirname(__file__), "data", "snapshot"
+    )
+
+    # how a worker picks up songs embedded elsewhere: "off", "poll" (updatedAt) or "changestream"
+    CATALOG_SYNC_MODE: str = "poll"
+    CATALOG_SYNC_INTERVAL: float = 5.0
+    # polls between two checks for deleted songs
+    CATALOG_SYNC_RECONCILE_EVERY: int = 60
+
+    # track details cached for hydrating recommendations, entries are refetched after TRACK_CACHE_TTL seconds
+    TRACK_CACHE_SIZE: int = 20000
+    TRACK_CACHE_TTL: float = 600.0
+
+    # cache of serialized recommendations: "off", "memory" (per worker) or "redis" (shared)
+    RESULT_CACHE_BACKEND: str = "memory"
+    # entries kept by the memory backend
+    RESULT_CACHE_SIZE: int = 10000
+    RESULT_CACHE_REDIS_URL: str = "redis://localhost:6379/0"
+    # seconds a result lives after it was written (redis: after the user's last write)
+    RESULT_CACHE_TTL: int = 3600
+
+    # concurrent recommendation calls for the same user share one computation
+    REQUEST_COALESCING: bool = True
+
+    # where precomputed top songs of active users go: "off", "mongo" (user_recommendations) or "memory"
+    PRECOMPUTE_STORE: str = "mongo"
+    # seconds between two runs of the background job
+    PRECOMPUTE_INTERVAL: float = 300.0
+    # users with an interaction updated in the last PRECOMPUTE_ACTIVE_WINDOW seconds are precomputed
+    PRECOMPUTE_ACTIVE_WINDOW: float = 86400.0
+    # a precomputed list is served while younger than this, otherwise the request is computed live
+    PRECOMPUTE_MAX_AGE: float = 900.0
+    PRECOMPUTE_MAX_USERS: int = 10000
+
+    # directory of the shared memory catalog manifest written by scripts/catalogSupervisor.py,
+    # empty means every worker loads its own copy
+    SHARED_CATALOG_DIR: str = ""
+    # seconds between two catalog rebuilds by the supervisor, 0 rebuilds only on SIGHUP
+    SHARED_CATALOG_REFRESH: float = 3600
+
+    # create missing mongo indexes at startup and report queries that scan a collection
+    ENSURE_INDEXES: bool = True
+
 
 settings = Settings()
@@ -7,19 +7,33 @@ from pymongo import UpdateOne
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.preprocessing import normalize
 
+from database.embeddingsCodec import encodeEmbedding
+
 
 class SingleSongEmbedding:
 
-    def __init__(self, songId, tracksDb, embeddingsDb, embeddingsModel):
+    def __init__(
+        self,
+        songId,
+        tracksDb,
+        embeddingsDb,
+        embeddingsModel,
+        embeddingsFormat="array",
+        embeddingCache=None,
+    ):
         self.song_id = songId
         self.tracks_collection = tracksDb
         self.embeddings_collection = embeddingsDb
         self.embeddings_model = embeddingsModel
         self.cached_min_max = None
         self.last_cache_update = None
+        self.embeddings = None
+        self.embeddings_format = embeddingsFormat
+        self.embedding_cache = embeddingCache
 
     def loadData(self):
         song_details = self.tracks_collection.find_one({"song_id": self.song_id})
+        self.song_details = song_details
         if song_details:
             track_detail = {
                 "song_id": song_details["song_id"],
@@ -146,6 +160,13 @@ class SingleSongEmbedding:
 
         self.textual_embeddings = None
 
+        if self.embedding_cache is not None:
+            # only numbers changed for most updates, the text is then a hit
+            self.textual_embeddings = self.embedding_cache.encode(
+                textual_data, self.embeddings_model.encode
+            )
+            return
+
         self.textual_embeddings = self.embeddings_model.encode(textual_data)
 
     def updatePopularity(self):
@@ -300,7 +321,9 @@ class SingleSongEmbedding:
         ndf = self.track_df[
             ["song_id", "spotify_id", "lastfm_id", "embeddings", "updatedAt"]
         ]
-        ndf["embeddings"] = ndf["embeddings"].apply(lambda row: row.tolist())
+        ndf["embeddings"] = ndf["embeddings"].apply(
+            lambda row: encodeEmbedding(row, self.embeddings_format)
+        )
 
         df_dict = ndf.to_dict(orient="records")
         print(len(df_dict))
@@ -1,8 +1,9 @@
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient, MongoClient
 
 
 class MongoConnect:
     client: MongoClient = None
+    async_client: AsyncMongoClient = None
 
     @classmethod
     def connect(cls, uri: str):
@@ -17,3 +18,17 @@ class MongoConnect:
             cls.client.close()
             print("Mongo db connection closed")
             cls.client = None
+
+    @classmethod
+    def connectAsync(cls, uri: str):
+        if cls.async_client is None:
+            cls.async_client = AsyncMongoClient(uri)
+            print("Async mongo db connected")
+        return cls.async_client
+
+    @classmethod
+    async def closeAsync(cls):
+        if cls.async_client:
+            await cls.async_client.close()
+            print("Async mongo db connection closed")
+            cls.async_client = None
@@ -0,0 +1,187 @@
+"""Here, I keep the normalized textual vector of every track text encoded so far in SQLite, so that re-embedding a song whose text did not change skips the model"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+
+def modelFingerprint(model_name):
+    """
+    Size and mtime of every file of a saved model (a directory, or the int8 .pt
+    file), so that another model saved to the same path gets another id. Empty for
+    a name that is not a local path.
+    """
+    if os.path.isfile(model_name):
+        paths = [model_name]
+    elif os.path.isdir(model_name):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(model_name)
+            for name in names
+        )
+    else:
+        return ""
+
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        entry = [os.path.relpath(path, model_name), stat.st_size, stat.st_mtime_ns]
+        digest.update(("|".join(str(part) for part in entry) + "\n").encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def modelId(model_name, max_seq_length):
+    """Identifies what produced a vector: another model, a model saved again or truncation never hits old entries"""
+    return (
+        str(model_name)
+        + "|"
+        + modelFingerprint(str(model_name))
+        + "|"
+        + str(max_seq_length)
+    )
+
+
+class EmbeddingCache:
+    """
+    Textual vectors keyed by sha256(model id + text), in a SQLite file.
+
+    - The text is the exact "Title: ... | Wiki_Summary: ..." string that is
+      encoded, so a song whose numbers changed (popularity, play counts) but
+      whose text did not is a hit.
+    - Vectors are stored normalized, as float32 bytes.
+    - Every lookup refreshes last_used. After a write the least recently used
+      entries beyond max_entries are deleted.
+    - WAL mode and a busy timeout let several workers share the file. One
+      connection per process, guarded by a lock, serves every thread.
+    """
+
+    def __init__(self, path, model_id, max_entries=500000):
+        self.path = path
+        self.model_id = model_id
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS text_embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS text_embeddings_last_used "
+            "ON text_embeddings (last_used)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def key(self, text):
+        return hashlib.sha256((self.model_id + "\0" + text).encode("utf-8")).hexdigest()
+
+    def getMany(self, keys):
+        """key -> float32 vector for the cached keys"""
+        found = dict()
+        now = time.time()
+        with self.lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    "SELECT key, vector FROM text_embeddings WHERE key IN ("
+                    + marks
+                    + ")",
+                    batch,
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+                self.connection.execute(
+                    "UPDATE text_embeddings SET last_used = ? WHERE key IN ("
+                    + marks
+                    + ")",
+                    [now] + batch,
+                )
+            self.connection.commit()
+        return found
+
+    def putMany(self, items):
+        """Stores (key, normalized vector) pairs and evicts down to max_entries"""
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO text_embeddings (key, vector, last_used) "
+                "VALUES (?, ?, ?)",
+                [
+                    (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                    for key, vector in items
+                ],
+            )
+            self.stats["stores"] += len(items)
+
+            (size,) = self.connection.execute(
+                "SELECT COUNT(*) FROM text_embeddings"
+            ).fetchone()
+            if size > self.max_entries:
+                evicted = self.connection.execute(
+                    "DELETE FROM text_embeddings WHERE key IN ("
+                    "SELECT key FROM text_embeddings ORDER BY last_used LIMIT ?)",
+                    (size - self.max_entries,),
+                ).rowcount
+                self.stats["evictions"] += evicted
+            self.connection.commit()
+
+    def encode(self, texts, encode):
+        """
+        Normalized textual vectors of texts, in order. Only the texts that are
+        not cached are passed to encode(list of texts), and their vectors stored.
+        """
+        texts = [str(text) for text in texts]
+        keys = [self.key(text) for text in texts]
+        found = self.getMany(list(dict.fromkeys(keys)))
+
+        missing = list(
+            dict.fromkeys(
+                (key, text) for key, text in zip(keys, texts) if key not in found
+            )
+        )
+        misses = sum(key not in found for key in keys)
+        with self.lock:
+            self.stats["hits"] += len(texts) - misses
+            self.stats["misses"] += misses
+
+        if missing:
+            vectors = normalize(encode([text for _, text in missing])).astype(
+                np.float32
+            )
+            new_items = [(key, vector) for (key, _), vector in zip(missing, vectors)]
+            self.putMany(new_items)
+            found.update(new_items)
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in keys])
+
+    def size(self):
+        with self.lock:
+            (size,) = self.connection.execute(
+                "SELECT COUNT(*) FROM text_embeddings"
+            ).fetchone()
+        return size
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(
+            self.stats,
+            size=self.size(),
+            hit_rate=self.stats["hits"] / lookups if lookups else None,
+        )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
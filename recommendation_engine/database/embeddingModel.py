@@ -0,0 +1,90 @@
+"""Here, I load the sentence embedding model named by EMBEDDINGS_MODEL: the saved fp32 SentenceTransformer directory, or the int8 weights written by scripts/saveEmbeddingModel.py --quantize"""
+
+import os
+import time
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+# EMBEDDINGS_MODEL paths with this suffix are quantized models
+QUANTIZED_SUFFIX = ".pt"
+QUANTIZED_FORMAT = 1
+
+
+def isQuantizedModel(path):
+    return str(path).endswith(QUANTIZED_SUFFIX)
+
+
+def quantizeModel(model):
+    """A copy with int8 weights in every Linear layer, activations quantized on the fly (CPU only)"""
+    return torch.ao.quantization.quantize_dynamic(
+        model.to("cpu").eval(), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def saveQuantizedModel(quantized, base_dir, path):
+    """
+    Only the quantized weights are written, with the fp32 directory they were
+    made from: the layers are rebuilt from it at load time. Pickling the whole
+    model would tie the file to the exact transformers classes and imports.
+    """
+    torch.save(
+        {
+            "format": QUANTIZED_FORMAT,
+            "quantization": "dynamic_int8",
+            # relative, so rec_models/ can move as a whole
+            "base": os.path.relpath(base_dir, os.path.dirname(os.path.abspath(path))),
+            "state_dict": quantized.state_dict(),
+        },
+        path,
+    )
+
+
+def loadQuantizedModel(path):
+    saved = torch.load(path, map_location="cpu", weights_only=True)
+    if saved.get("format") != QUANTIZED_FORMAT:
+        raise ValueError("unknown quantized model format: " + str(saved.get("format")))
+
+    base_dir = os.path.join(os.path.dirname(os.path.abspath(path)), saved["base"])
+    model = quantizeModel(SentenceTransformer(base_dir, device="cpu"))
+    model.load_state_dict(saved["state_dict"])
+    return model
+
+
+def loadEmbeddingModel(path):
+    if isQuantizedModel(path):
+        return loadQuantizedModel(path)
+    return SentenceTransformer(path, device="cpu")
+
+
+def compareModels(reference, candidate, texts, batch_size=32):
+    """
+    Parity and throughput of candidate against reference on texts: the cosine
+    between the two vectors of every text, and texts/s of each model.
+    """
+    timings = dict()
+    vectors = dict()
+    for name, model in (("reference", reference), ("candidate", candidate)):
+        started = time.perf_counter()
+        vectors[name] = model.encode(
+            texts, batch_size=batch_size, show_progress_bar=False
+        )
+        timings[name] = time.perf_counter() - started
+
+    reference_vectors = vectors["reference"] / np.linalg.norm(
+        vectors["reference"], axis=1, keepdims=True
+    )
+    candidate_vectors = vectors["candidate"] / np.linalg.norm(
+        vectors["candidate"], axis=1, keepdims=True
+    )
+    cosines = (reference_vectors * candidate_vectors).sum(axis=1)
+
+    return {
+        "texts": len(texts),
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "reference_texts_per_second": len(texts) / timings["reference"],
+        "candidate_texts_per_second": len(texts) / timings["candidate"],
+        "speedup": timings["reference"] / timings["candidate"],
+    }
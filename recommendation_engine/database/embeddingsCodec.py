@@ -0,0 +1,53 @@
+"""Here, I convert embeddings to and from what is stored in songs_embeddings: an array of doubles, or a packed float32 BSON binary vector"""
+
+import numpy as np
+from bson.binary import VECTOR_SUBTYPE, Binary, BinaryVectorDtype
+
+
+# "array" stores a list of doubles, "binary" a BSON binary vector (subtype 9)
+EMBEDDINGS_FORMATS = ("array", "binary")
+
+# a binary vector is a dtype byte, a padding byte and then little-endian float32 values
+VECTOR_HEADER_SIZE = 2
+FLOAT32_HEADER = BinaryVectorDtype.FLOAT32.value + b"\x00"
+FLOAT32_LE = np.dtype("<f4")
+
+
+def encodeEmbedding(vector, embeddings_format="array"):
+    if embeddings_format not in EMBEDDINGS_FORMATS:
+        raise ValueError("unknown embeddings format: " + str(embeddings_format))
+
+    vector = np.asarray(vector)
+    if embeddings_format == "array":
+        return vector.tolist()
+    return Binary(FLOAT32_HEADER + vector.astype(FLOAT32_LE).tobytes(), VECTOR_SUBTYPE)
+
+
+def isBinaryEmbedding(value):
+    return isinstance(value, Binary) and value.subtype == VECTOR_SUBTYPE
+
+
+def embeddingDim(value):
+    if isBinaryEmbedding(value):
+        return (len(value) - VECTOR_HEADER_SIZE) // FLOAT32_LE.itemsize
+    return len(value)
+
+
+def decodeEmbedding(value, out=None):
+    """
+    Decodes a stored embedding to float32, into out when given.
+
+    A binary vector is read straight from its bytes with np.frombuffer, no
+    Python float is created for it.
+    """
+    if isBinaryEmbedding(value):
+        if bytes(value[:VECTOR_HEADER_SIZE]) != FLOAT32_HEADER:
+            raise ValueError("only float32 binary vectors are supported")
+        vector = np.frombuffer(value, dtype=FLOAT32_LE, offset=VECTOR_HEADER_SIZE)
+    else:
+        vector = np.asarray(value, dtype=np.float32)
+
+    if out is None:
+        return vector.astype(np.float32)
+    out[:] = vector
+    return out
@@ -0,0 +1,275 @@
+"""Here, I write the song embeddings to a snapshot on disk (float32 .npy matrix, norms, song id sidecar and a manifest) that every worker can memory map"""
+
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from database.embeddingsCodec import decodeEmbedding, embeddingDim
+
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+# same format as the updatedAt field of songs_embeddings, so the two can be compared
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+# rows copied or decoded at a time while a snapshot is written
+SNAPSHOT_BLOCK_ROWS = 65536
+
+
+def loadEmbeddingsFromCollection(embeddings_collection):
+    """
+    song_ids and a float32 matrix of every song that has embeddings.
+
+    Every embedding is decoded straight into a row of one buffer sized from the
+    collection's estimated count, instead of building a list of lists first.
+    """
+    cursor = embeddings_collection.find(
+        {}, projection={"_id": False, "song_id": True, "embeddings": True}
+    )
+    capacity = max(embeddings_collection.estimated_document_count(), 1)
+
+    song_ids = list()
+    buffer = None
+    for doc in cursor:
+        value = doc.get("embeddings")
+        if not value:
+            continue
+
+        if buffer is None:
+            buffer = np.empty((capacity, embeddingDim(value)), dtype=np.float32)
+        elif len(song_ids) == buffer.shape[0]:
+            # the estimate was low, double the buffer
+            buffer = np.concatenate([buffer, np.empty_like(buffer)])
+
+        decodeEmbedding(value, out=buffer[len(song_ids)])
+        song_ids.append(doc["song_id"])
+
+    if buffer is None:
+        return song_ids, np.zeros((0, 0), dtype=np.float32)
+    return song_ids, buffer[: len(song_ids)]
+
+
+class SnapshotWriter:
+    """
+    Writes a new snapshot version of rows x dim block by block: the matrix is an
+    .npy file opened with open_memmap, so it is never held in memory as a whole.
+
+    - Data files carry the version in their name and commit() replaces the
+      manifest atomically, so a reader sees either the old or the new snapshot,
+      never a mix.
+    - updated_at is the updatedAt of songs_embeddings up to which the snapshot is
+      complete, later changes are read from the collection at startup.
+    - Only the newest keep versions are kept on disk.
+    """
+
+    def __init__(self, snapshot_dir, rows, dim):
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self.snapshot_dir = snapshot_dir
+        self.version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.files = {
+            "embeddings": "embeddings_" + self.version + ".npy",
+            "norms": "norms_" + self.version + ".npy",
+            "song_ids": "song_ids_" + self.version + ".json",
+        }
+        self.embeddings = np.lib.format.open_memmap(
+            os.path.join(snapshot_dir, self.files["embeddings"]),
+            mode="w+",
+            dtype=np.float32,
+            shape=(rows, dim),
+        )
+        self.norms = np.zeros((rows,), dtype=np.float32)
+
+    def write(self, start, block):
+        """Rows start..start+len(block)-1"""
+        block = np.nan_to_num(np.asarray(block, dtype=np.float32), nan=0.0)
+        self.embeddings[start : start + block.shape[0]] = block
+        self.norms[start : start + block.shape[0]] = np.linalg.norm(block, axis=1)
+
+    def writeRows(self, rows, vectors):
+        vectors = np.nan_to_num(np.asarray(vectors, dtype=np.float32), nan=0.0)
+        self.embeddings[rows] = vectors
+        self.norms[rows] = np.linalg.norm(vectors, axis=1)
+
+    def commit(self, song_ids, updated_at, keep=2):
+        rows, dim = self.embeddings.shape
+        self.embeddings.flush()
+        self.embeddings = None
+
+        np.save(os.path.join(self.snapshot_dir, self.files["norms"]), self.norms)
+        with open(os.path.join(self.snapshot_dir, self.files["song_ids"]), "w") as f:
+            json.dump([str(song_id) for song_id in song_ids], f)
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": self.version,
+            "rows": int(rows),
+            "dim": int(dim),
+            "dtype": "float32",
+            "updated_at": updated_at,
+            "files": self.files,
+        }
+        manifest_path = os.path.join(self.snapshot_dir, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        removeOldVersions(self.snapshot_dir, keep)
+        print("embeddings snapshot written: ", self.version, ", rows: ", rows)
+        return manifest
+
+
+def removeOldVersions(snapshot_dir, keep):
+    # workers that still map a removed file keep reading it until they let go of it
+    versions = sorted(
+        {
+            name.rsplit("_", 1)[1].split(".")[0]
+            for name in os.listdir(snapshot_dir)
+            if name.startswith(("embeddings_", "norms_", "song_ids_"))
+        }
+    )
+    for version in versions[:-keep]:
+        for name in (
+            "embeddings_" + version + ".npy",
+            "norms_" + version + ".npy",
+            "song_ids_" + version + ".json",
+        ):
+            path = os.path.join(snapshot_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def readSnapshot(snapshot_dir, mmap_mode="r"):
+    """Returns (manifest, song_ids, embeddings, norms) with embeddings memory mapped, or None if there is no usable snapshot"""
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        print("embeddings snapshot has an unknown format: ", manifest.get("format"))
+        return None
+
+    files = manifest["files"]
+    try:
+        embeddings = np.load(
+            os.path.join(snapshot_dir, files["embeddings"]), mmap_mode=mmap_mode
+        )
+        norms = np.load(os.path.join(snapshot_dir, files["norms"]))
+        with open(os.path.join(snapshot_dir, files["song_ids"])) as f:
+            song_ids = json.load(f)
+    except (OSError, ValueError) as e:
+        print("could not read embeddings snapshot ", manifest["version"], ": ", e)
+        return None
+
+    if embeddings.shape[0] != len(song_ids) or norms.shape[0] != len(song_ids):
+        print("embeddings snapshot ", manifest["version"], " is inconsistent")
+        return None
+
+    return manifest, song_ids, embeddings, norms
+
+
+def rebuildSnapshot(
+    snapshot_dir, embeddings_collection, block_rows=SNAPSHOT_BLOCK_ROWS
+):
+    """
+    Writes a snapshot of everything in the collection.
+
+    The number of rows is only known once the cursor is done, so the decoded rows
+    go to an unnamed scratch file first and are then copied into the snapshot
+    block by block. Only one block is in memory at a time.
+    """
+    # taken before the read, so that nothing written during it is missed later
+    updated_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    cursor = embeddings_collection.find(
+        {}, projection={"_id": False, "song_id": True, "embeddings": True}
+    )
+
+    song_ids = list()
+    dim = None
+    with tempfile.TemporaryFile(dir=snapshot_dir) as scratch:
+        block = list()
+        for doc in cursor:
+            value = doc.get("embeddings")
+            if not value:
+                continue
+            if dim is None:
+                dim = embeddingDim(value)
+            block.append(decodeEmbedding(value))
+            song_ids.append(doc["song_id"])
+            if len(block) == block_rows:
+                scratch.write(np.asarray(block, dtype=np.float32).tobytes())
+                block = list()
+        if block:
+            scratch.write(np.asarray(block, dtype=np.float32).tobytes())
+        scratch.flush()
+
+        if not song_ids:
+            print("no embeddings, snapshot not written")
+            return None
+
+        decoded = np.memmap(
+            scratch, dtype=np.float32, mode="r", shape=(len(song_ids), dim)
+        )
+        writer = SnapshotWriter(snapshot_dir, len(song_ids), dim)
+        for start in range(0, len(song_ids), block_rows):
+            writer.write(start, decoded[start : start + block_rows])
+        del decoded
+
+    return writer.commit(song_ids, updated_at)
+
+
+def loadChangesSince(embeddings_collection, updated_at):
+    """song_id -> embedding of every song written at or after updated_at (updatedAt_1 index)"""
+    cursor = embeddings_collection.find(
+        {"updatedAt": {"$gte": updated_at}},
+        projection={"_id": False, "song_id": True, "embeddings": True},
+    )
+    return {
+        doc["song_id"]: decodeEmbedding(doc["embeddings"])
+        for doc in cursor
+        if doc.get("embeddings")
+    }
+
+
+def updateSnapshot(snapshot_dir, embeddings_collection, block_rows=SNAPSHOT_BLOCK_ROWS):
+    """
+    Writes a snapshot with every song written since the current one added or
+    replaced, or one of the whole collection when there is no snapshot yet.
+
+    The changes come from one updatedAt query, so the new snapshot is complete up
+    to the time of that read and workers that start from it have nothing left to
+    catch up on. The current snapshot is copied from its memory map in row blocks,
+    then the changed and new rows are written over and after it.
+    """
+    current = readSnapshot(snapshot_dir)
+    if current is None:
+        return rebuildSnapshot(snapshot_dir, embeddings_collection, block_rows)
+
+    manifest, base_song_ids, base_embeddings, _ = current
+    row_of = {song_id: row for row, song_id in enumerate(base_song_ids)}
+
+    # taken before the read, so that nothing written during it is missed later
+    updated_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+    changes = loadChangesSince(embeddings_collection, manifest["updated_at"])
+
+    song_ids = list(base_song_ids)
+    rows = list()
+    for song_id in changes:
+        row = row_of.get(str(song_id))
+        if row is None:
+            row = len(song_ids)
+            song_ids.append(song_id)
+        rows.append(row)
+
+    writer = SnapshotWriter(snapshot_dir, len(song_ids), base_embeddings.shape[1])
+    for start in range(0, len(base_song_ids), block_rows):
+        writer.write(start, base_embeddings[start : start + block_rows])
+    del base_embeddings
+    if rows:
+        writer.writeRows(np.asarray(rows, dtype=np.int64), list(changes.values()))
+
+    return writer.commit(song_ids, updated_at)
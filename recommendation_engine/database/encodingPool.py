@@ -0,0 +1,133 @@
+"""Here, I spread bulk text encoding over several processes, each with its own copy of the model, so a re-embed uses every core of the machine"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from database.textEncoder import TextEncoder
+
+# the encoder of a pool process, set by initEncodingWorker
+worker_encoder = None
+
+
+def initEncodingWorker(model_name, max_seq_length, batch_size, threads):
+    global worker_encoder
+
+    # imported here: the parent only needs them when it encodes itself
+    import torch
+
+    from database.embeddingModel import loadEmbeddingModel
+
+    # every process gets its share of the cores, not all of them
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    # the same fp32 or int8 model as the server
+    model = loadEmbeddingModel(model_name)
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+    worker_encoder = TextEncoder(model, batch_size)
+
+
+def encodeShard(texts):
+    """Vectors of one shard and the encoder stats they added"""
+    before = dict(worker_encoder.stats)
+    vectors = worker_encoder.encode(texts)
+    return vectors, {key: worker_encoder.stats[key] - before[key] for key in before}
+
+
+class EncodingPool:
+    """
+    A TextEncoder replacement that shards texts over worker processes.
+
+    - Every worker loads the model from model_name once, with
+      threads_per_worker torch threads (0 = cores / workers), so the workers
+      do not oversubscribe the CPU.
+    - A call is sorted by text length and cut into one shard per worker, of
+      about the same total length. Every worker buckets its shard by token length,
+      and the vectors are put back in the input order.
+    - Processes are spawned, not forked, so they do not inherit the server's
+      threads, sockets or torch state.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        workers,
+        max_seq_length=None,
+        batch_size=32,
+        threads_per_worker=0,
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initEncodingWorker,
+            initargs=(model_name, max_seq_length, batch_size, threads),
+        )
+        self.stats = {
+            "texts": 0,
+            "batches": 0,
+            "tokens": 0,
+            "padded_tokens": 0,
+            "seconds": 0.0,
+        }
+        print("encoding pool: ", workers, " workers, ", threads, " threads each")
+
+    def encode(self, texts):
+        texts = [str(text) for text in texts]
+        started = time.perf_counter()
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        # shards of similar lengths keep the workers' batches tightly packed, and
+        # cutting at equal total length (not count) keeps the workers equally busy
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        order = np.argsort(-lengths, kind="stable")
+        shard_count = max(1, min(self.workers, len(texts) // self.batch_size))
+        cumulative = np.cumsum(lengths[order])
+        cuts = np.searchsorted(
+            cumulative, cumulative[-1] * np.arange(1, shard_count) / shard_count
+        )
+        bounds = [0] + sorted(set(int(cut) for cut in cuts) - {0}) + [len(texts)]
+        shards = [
+            [texts[i] for i in order[start:end]]
+            for start, end in zip(bounds, bounds[1:])
+            if end > start
+        ]
+
+        embeddings = None
+        start = 0
+        for shard_vectors, shard_stats in self.executor.map(encodeShard, shards):
+            if embeddings is None:
+                embeddings = np.empty(
+                    (len(texts), shard_vectors.shape[1]), shard_vectors.dtype
+                )
+            # back to the input order
+            embeddings[order[start : start + len(shard_vectors)]] = shard_vectors
+            start += len(shard_vectors)
+            for key, value in shard_stats.items():
+                if key != "seconds":
+                    self.stats[key] += value
+        self.stats["seconds"] += time.perf_counter() - started
+        return embeddings
+
+    def report(self):
+        seconds = self.stats["seconds"]
+        padded = self.stats["padded_tokens"]
+        return dict(
+            self.stats,
+            workers=self.workers,
+            tokens_per_second=self.stats["tokens"] / seconds if seconds else None,
+            padding_share=1 - self.stats["tokens"] / padded if padded else None,
+        )
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
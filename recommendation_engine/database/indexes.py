@@ -0,0 +1,147 @@
+"""Here, I declare the indexes the engine's queries rely on, create the missing ones at startup, and report queries that still scan a whole collection"""
+
+from datetime import datetime
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# collection -> indexes the engine needs
+REQUIRED_INDEXES = {
+    "trackdetails": [
+        IndexModel([("song_id", ASCENDING)], name="song_id_1"),
+        # artists is an array of sub documents, so this is a multikey index
+        IndexModel([("artists.name", ASCENDING)], name="artists.name_1"),
+        # tags is an array of normalized tags, also multikey
+        IndexModel([("tags", ASCENDING)], name="tags_1"),
+        IndexModel([("embeddingsStatus", ASCENDING)], name="embeddingsStatus_1"),
+    ],
+    "songs_embeddings": [
+        IndexModel([("song_id", ASCENDING)], name="song_id_1"),
+        # catching up on changes made after the embeddings snapshot was written
+        IndexModel([("updatedAt", ASCENDING)], name="updatedAt_1"),
+    ],
+    "userfavartists": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_1"),
+    ],
+    "userfavgenres": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_1"),
+    ],
+    "usersonginteractions": [
+        IndexModel(
+            [("user_id", ASCENDING), ("song_id", ASCENDING)],
+            name="user_id_1_song_id_1",
+        ),
+        # recently active users for the precompute job
+        IndexModel([("updatedAt", ASCENDING)], name="updatedAt_1"),
+    ],
+    "user_recommendations": [
+        # removing precomputed lists that got too old
+        IndexModel([("computed_at", ASCENDING)], name="computed_at_1"),
+    ],
+}
+
+# collection -> query filters the engine sends, checked with explain()
+QUERY_SHAPES = {
+    "trackdetails": [
+        {"song_id": "x"},
+        {"song_id": {"$in": ["x", "y"]}},
+        {"artists.name": {"$in": ["x", "y"]}},
+        {"tags": {"$in": ["x", "y"]}},
+        {"embeddingsStatus": "pending"},
+    ],
+    "songs_embeddings": [
+        {"song_id": "x"},
+        {"updatedAt": {"$gte": "2025-01-01 00:00:00"}},
+    ],
+    "userfavartists": [
+        {"user_id": "x"},
+        {"user_id": {"$in": ["x", "y"]}},
+    ],
+    "userfavgenres": [
+        {"user_id": "x"},
+        {"user_id": {"$in": ["x", "y"]}},
+    ],
+    "usersonginteractions": [
+        {"user_id": "x"},
+        {"user_id": {"$in": ["x", "y"]}},
+        {"updatedAt": {"$gte": datetime(2025, 1, 1)}},
+    ],
+}
+
+
+def indexKey(index_model):
+    return tuple(index_model.document["key"].items())
+
+
+def ensureIndexes(db, required_indexes=REQUIRED_INDEXES):
+    """
+    Creates the required indexes that are missing.
+
+    An existing index on the same keys is accepted whatever its name or options
+    (e.g. the unique song_id index mongoose creates), so this never fails on a
+    conflict with indexes made elsewhere.
+
+    Returns {collection: {"existing": [...], "created": [...], "failed": [...]}}
+    """
+    report = dict()
+    for collection_name, index_models in required_indexes.items():
+        collection = db[collection_name]
+        existing_keys = {
+            tuple(info["key"]): name
+            for name, info in collection.index_information().items()
+        }
+
+        collection_report = {"existing": [], "created": [], "failed": []}
+        for index_model in index_models:
+            key = indexKey(index_model)
+            if key in existing_keys:
+                collection_report["existing"].append(existing_keys[key])
+                continue
+
+            try:
+                collection.create_indexes([index_model])
+                collection_report["created"].append(index_model.document["name"])
+            except OperationFailure as e:
+                print("could not create index on ", collection_name, ": ", e)
+                collection_report["failed"].append(index_model.document["name"])
+
+        report[collection_name] = collection_report
+        print("indexes for ", collection_name, ": ", collection_report)
+
+    return report
+
+
+def planStages(plan):
+    """All stage names of an explain() plan tree"""
+    stages = [plan.get("stage")]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += planStages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += planStages(child)
+    return stages
+
+
+def reportCollectionScans(db, query_shapes=QUERY_SHAPES):
+    """Runs explain() for every query shape and returns the ones whose winning plan is a COLLSCAN"""
+    collection_scans = list()
+    for collection_name, filters in query_shapes.items():
+        for query_filter in filters:
+            try:
+                explained = db[collection_name].find(query_filter).explain()
+            except OperationFailure as e:
+                # e.g. no explain privilege: the check is only a report, never fatal
+                print("could not explain query on ", collection_name, ": ", e)
+                continue
+            winning_plan = explained.get("queryPlanner", {}).get("winningPlan", {})
+            if "COLLSCAN" in planStages(winning_plan):
+                collection_scans.append(
+                    {"collection": collection_name, "filter": query_filter}
+                )
+
+    if collection_scans:
+        print("WARNING: these queries scan the whole collection: ", collection_scans)
+    else:
+        print("every engine query shape is served by an index")
+
+    return collection_scans
@@ -1,32 +1,272 @@
 """Here, I will get tracks details from database, create their embeddings, and update the database"""
 
+import queue
+import threading
+import time
 from datetime import datetime
 import pandas as pd
-import pickle as pkl
 import numpy as np
 from sklearn.preprocessing import normalize
 
 from pymongo import UpdateOne
-from sklearn.preprocessing import MinMaxScaler
+
+from database.embeddingsCodec import encodeEmbedding
+from database.embeddingsSnapshot import rebuildSnapshot, updateSnapshot
+from database.encodingPool import EncodingPool
+from database.textEncoder import TextEncoder
+
+# numeric fields that are min-max scaled into the embedding
+SCALED_FIELDS = ["year", "duration", "total_play_counts", "total_listeners_counts"]
+
+# weights of the popularity score computed for songs that do not have one
+W_PLAY = 0.55
+W_LISTENERS = 0.30
+W_LISTENERS_1 = 0.35
+W_SPOTIFY = 0.15
+
+# songs whose popularity_score is (re)computed
+NEEDS_POPULARITY = [
+    {"popularity_score": None},
+    {"popularity_score": {"$lte": 0}},
+    {"spotify_popularity": {"$lte": 0}},
+]
+
+# chunks waiting between two stages: memory is bounded by about
+# (2 * STAGE_QUEUE_SIZE + 3) chunks whatever the size of the catalog
+STAGE_QUEUE_SIZE = 2
+
+# songs of a run merged into the snapshot, beyond that it is rebuilt from the collection
+SNAPSHOT_MERGE_LIMIT = 50000
+
+# marks the end of a stage's output
+END_OF_STAGE = object()
+
+
+def minMaxScale(values, bounds):
+    """Same as MinMaxScaler().fit_transform on the column the bounds come from"""
+    values = np.asarray(values, dtype=np.float64).reshape(-1, 1)
+    low, high = bounds
+    if low is None or high is None:
+        return np.full(values.shape, np.nan)
+
+    scale = high - low
+    # MinMaxScaler leaves a constant column at 0 instead of dividing by 0
+    if scale == 0:
+        scale = 1.0
+    return (values - low) / scale
+
+
+def scaledFieldExpression(field, bounds):
+    low, high = bounds
+    if low is None or high is None:
+        return None
+    scale = high - low
+    if scale == 0:
+        scale = 1.0
+    return {"$divide": [{"$subtract": ["$" + field, low]}, scale]}
+
+
+def fieldBounds(stats, field):
+    if not stats:
+        return (None, None)
+    return (stats.get(field + "_min"), stats.get(field + "_max"))
+
+
+def getScalingBounds(tracks_collection, query):
+    """
+    Min/max of every scaled column over all the songs that match query, with two
+    aggregations, so that each chunk is scaled exactly as the whole frame was.
+
+    - The scaled fields and the popularity_score of songs that keep theirs come
+      from the first one.
+    - The popularity of the other songs is a weighted sum of scaled play and
+      listener counts (and spotify popularity when any of them has it), min-max
+      scaled to 1..100. The bounds of that sum come from the second one.
+    """
+    raw_group = {"_id": None}
+    for field in SCALED_FIELDS:
+        raw_group[field + "_min"] = {"$min": "$" + field}
+        raw_group[field + "_max"] = {"$max": "$" + field}
+
+    pipeline = [
+        {"$match": query},
+        {
+            "$facet": {
+                "raw": [{"$group": raw_group}],
+                "kept": [
+                    {"$match": {"$nor": NEEDS_POPULARITY}},
+                    {
+                        "$group": {
+                            "_id": None,
+                            "popularity_score_min": {"$min": "$popularity_score"},
+                            "popularity_score_max": {"$max": "$popularity_score"},
+                        }
+                    },
+                ],
+                "needs": [
+                    {"$match": {"$or": NEEDS_POPULARITY}},
+                    {
+                        "$group": {
+                            "_id": None,
+                            "spotify_popularity_max": {"$max": "$spotify_popularity"},
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    facets = next(tracks_collection.aggregate(pipeline), None) or dict()
+    raw = (facets.get("raw") or [None])[0]
+    kept = (facets.get("kept") or [None])[0]
+    needs = (facets.get("needs") or [None])[0]
+
+    bounds = {field: fieldBounds(raw, field) for field in SCALED_FIELDS}
+    spotify_max = needs.get("spotify_popularity_max") if needs else None
+    bounds["use_spotify"] = spotify_max is not None and spotify_max > 0
+
+    bounds["combined"] = (None, None)
+    play = scaledFieldExpression("total_play_counts", bounds["total_play_counts"])
+    listeners = scaledFieldExpression(
+        "total_listeners_counts", bounds["total_listeners_counts"]
+    )
+    if needs is not None and play is not None and listeners is not None:
+        if bounds["use_spotify"]:
+            terms = [
+                {"$multiply": [W_PLAY, play]},
+                {"$multiply": [W_LISTENERS, listeners]},
+                {"$multiply": [W_SPOTIFY, {"$divide": ["$spotify_popularity", 100]}]},
+            ]
+        else:
+            terms = [
+                {"$multiply": [W_PLAY, play]},
+                {"$multiply": [W_LISTENERS_1, listeners]},
+            ]
+        pipeline = [
+            {"$match": {"$and": [query, {"$or": NEEDS_POPULARITY}]}},
+            {
+                "$group": {
+                    "_id": None,
+                    "combined_min": {"$min": {"$add": terms}},
+                    "combined_max": {"$max": {"$add": terms}},
+                }
+            },
+        ]
+        bounds["combined"] = fieldBounds(
+            next(tracks_collection.aggregate(pipeline), None), "combined"
+        )
+
+    # the recomputed scores span 1..100 (only 1 when the sums are all equal),
+    # popularity_normalized is scaled over those and the kept ones together
+    popularity = [value for value in fieldBounds(kept, "popularity_score")]
+    low, high = bounds["combined"]
+    if low is not None:
+        popularity.extend([1.0, 100.0 if high > low else 1.0])
+    popularity = [value for value in popularity if value is not None]
+    bounds["popularity_score"] = (
+        (min(popularity), max(popularity)) if popularity else (None, None)
+    )
+    return bounds
+
+
+def putUnlessStopped(stage_queue, item, stopped):
+    """Blocks while the next stage is busy, gives up when the pipeline stopped"""
+    while not stopped.is_set():
+        try:
+            stage_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def getUnlessStopped(stage_queue, stopped):
+    """The next item of the previous stage, or END_OF_STAGE when the pipeline stopped"""
+    while not stopped.is_set():
+        try:
+            return stage_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return END_OF_STAGE
 
 
 class EmbeddingsOps:
+    """
+    Re-embeds the pending songs (or every song with forceUpdate) as a pipeline of
+    chunks of chunkSize tracks, so peak memory depends on the chunk size and not
+    on the size of the catalog:
+
+    - a reader thread pulls chunks from a batched cursor and sanitizes them,
+    - the calling thread computes the numeric features and encodes the texts,
+    - a writer thread appends the chunk to the CSV files, writes its embeddings
+      and marks its tracks as done.
+
+    Stages hand chunks over through bounded queues, so reading, encoding and
+    writing overlap and a slow stage holds back the others. Min/max scaling uses
+    bounds aggregated over all the matching songs before the first chunk.
+    """
 
     def __init__(
-        self, embeddingsCollection, tracksCollection, embeddingModel, forceUpdate
+        self,
+        embeddingsCollection,
+        tracksCollection,
+        embeddingModel,
+        forceUpdate,
+        snapshotDir=None,
+        embeddingsFormat="array",
+        chunkSize=1000,
+        encodeBatchSize=32,
+        embeddingCache=None,
+        encodeWorkers=1,
+        modelName=None,
+        encodeThreads=0,
     ):
         self.embeddings_collection = embeddingsCollection
         self.tracks_collection = tracksCollection
         self.embeddingModel = embeddingModel
         self.forceUpdate = forceUpdate
+        self.snapshot_dir = snapshotDir
+        self.embeddings_format = embeddingsFormat
+        self.chunk_size = chunkSize
+        # length bucketed batches, also counts tokens/s
+        self.text_encoder = TextEncoder(embeddingModel, encodeBatchSize)
+        # vectors of texts encoded before, None encodes every text
+        self.embedding_cache = embeddingCache
+        # with more than one worker, texts are encoded by a process pool that
+        # loads modelName, started for the run and closed after it
+        self.encode_batch_size = encodeBatchSize
+        self.encode_workers = encodeWorkers
+        self.model_name = modelName
+        self.encode_threads = encodeThreads
+        self.encoding_pool = None
+
+        self.stopped = threading.Event()
+        self.errors = list()
+        self.timings = {"read": 0.0, "encode": 0.0, "write": 0.0}
+        self.rows = 0
+        self.file_stamp = None
+        self.tracks_file_columns = None
+
+    def tracksQuery(self):
+        if self.forceUpdate == "true":
+            return {}
+        return {"embeddingsStatus": "pending"}
 
     def getTracksFromDb(self):
-        if self.forceUpdate == "true":
-            tracks_list = self.tracks_collection.find()
-        else:
-            tracks_list = self.tracks_collection.find({"embeddingsStatus": "pending"})
-        self.tracks_list_df = pd.DataFrame(list(tracks_list))
-        print("shape of data: ", self.tracks_list_df.shape)
+        """Yields the matching tracks as dataframes of at most chunk_size rows"""
+        cursor = self.tracks_collection.find(
+            self.tracksQuery(), batch_size=self.chunk_size
+        )
+        try:
+            chunk = list()
+            for doc in cursor:
+                chunk.append(doc)
+                if len(chunk) == self.chunk_size:
+                    yield pd.DataFrame(chunk)
+                    chunk = list()
+            if chunk:
+                yield pd.DataFrame(chunk)
+        finally:
+            cursor.close()
 
     def concatenateNames(self, artist):
         artist_names_list = list()
@@ -39,143 +279,118 @@ class EmbeddingsOps:
 
         return artist_names
 
-    def sanitizeDataframe(self):
-        column_list = self.tracks_list_df.columns
-        print("col list: ", column_list)
+    def sanitizeDataframe(self, tracks_df):
+        column_list = tracks_df.columns
 
         if "_id" in column_list:
-            self.tracks_list_df.drop(columns=["_id"], inplace=True)
+            tracks_df.drop(columns=["_id"], inplace=True)
 
         if "__v" in column_list:
-            self.tracks_list_df.drop(columns=["__v"], inplace=True)
+            tracks_df.drop(columns=["__v"], inplace=True)
 
         if "updateAt" in column_list:
-            self.tracks_list_df.drop(columns=["updatedAt"], inplace=True)
+            tracks_df.drop(columns=["updatedAt"], inplace=True)
 
         if "embeddingsStatus" in column_list:
-            self.tracks_list_df.drop(columns=["embeddingsStatus"], inplace=True)
+            tracks_df.drop(columns=["embeddingsStatus"], inplace=True)
 
         if "source" in column_list:
-            self.tracks_list_df.drop(columns=["source"], inplace=True)
+            tracks_df.drop(columns=["source"], inplace=True)
 
-        self.tracks_list_df["artists"] = self.tracks_list_df["artists"].apply(
+        tracks_df["artists"] = tracks_df["artists"].apply(
             lambda x: self.concatenateNames(x)
         )
+        return tracks_df
 
-    def createTextualEmbeddings(self):
+    def createTextualEmbeddings(self, tracks_df):
         textual_data = (
             "Title: "
-            + self.tracks_list_df["title"].astype(str)
+            + tracks_df["title"].astype(str)
             + " | Artists: "
-            + self.tracks_list_df["artists"].astype(str)
+            + tracks_df["artists"].astype(str)
             + " | Album: "
-            + self.tracks_list_df["release"].astype(str)
+            + tracks_df["release"].astype(str)
             + " | Tags: "
-            + self.tracks_list_df["all_tags"].replace("_", ",").astype(str)
+            + tracks_df["all_tags"].replace("_", ",").astype(str)
             + " | Wiki_Summary: "
-            + self.tracks_list_df["wiki_summary"].astype(str)
+            + tracks_df["wiki_summary"].astype(str)
         )
 
-        self.textual_embeddings = None
+        if self.embedding_cache is not None:
+            return self.embedding_cache.encode(textual_data, self.text_encoder.encode)
+        return self.text_encoder.encode(textual_data)
 
-        self.textual_embeddings = self.embeddingModel.encode(textual_data)
-
-    def createNumericalEmbeddings(self):
+    def createNumericalEmbeddings(self, tracks_df):
         """
-        Updates the 'popularity_score' column in a tracks DataFrame
-        using normalized numerical features (play counts, listeners, Spotify popularity).
+        Updates the 'popularity_score' column of a chunk of tracks using normalized
+        numerical features (play counts, listeners, Spotify popularity).
 
         - Only updates rows where popularity_score == 0 or is NaN.
-        - Scales relevant columns with MinMaxScaler.
+        - Scales relevant columns with the bounds of all the matching songs.
         - Combines multiple signals with weighted sum.
         """
-
-        # self.tracks_list_df = self.tracks_list_df.copy(deep=True)
-        mnmx_scaler = MinMaxScaler()
+        bounds = self.scaling_bounds
 
         # --- Normalize relevant numeric columns ---
-        years_normalized = mnmx_scaler.fit_transform(
-            self.tracks_list_df["year"].values.reshape(-1, 1)
-        )
-        duration_normalized = mnmx_scaler.fit_transform(
-            self.tracks_list_df[["duration"]]
-        )
-        total_play_counts_normalized = mnmx_scaler.fit_transform(
-            self.tracks_list_df[["total_play_counts"]]
+        years_normalized = minMaxScale(tracks_df["year"], bounds["year"])
+        duration_normalized = minMaxScale(tracks_df["duration"], bounds["duration"])
+        total_play_counts_normalized = minMaxScale(
+            tracks_df["total_play_counts"], bounds["total_play_counts"]
         )
-        total_listeners_count_normalized = mnmx_scaler.fit_transform(
-            self.tracks_list_df[["total_listeners_counts"]]
+        total_listeners_count_normalized = minMaxScale(
+            tracks_df["total_listeners_counts"], bounds["total_listeners_counts"]
         )
         spotify_popularity_score_normalized = (
-            self.tracks_list_df["spotify_popularity"] / 100
+            tracks_df["spotify_popularity"] / 100
         ).values.reshape(-1, 1)
 
-        # --- Define weights for combining features ---
-        w_play = 0.55
-        w_listeners = 0.30
-        w_listeners_1 = 0.35
-        w_spotify = 0.15
-
         # --- Mask for songs needing an update ---
-        # mask = (self.tracks_list_df["popularity_score"].isna()) | (
-        #     self.tracks_list_df["popularity_score"]
-        #     <= 0 | (self.tracks_list_df["spotify_popularity"] <= 0)
-        # )
-
         mask = (
-            (self.tracks_list_df["popularity_score"].isna())
-            | (self.tracks_list_df["popularity_score"] <= 0)
-            | (self.tracks_list_df["spotify_popularity"] <= 0)
+            (tracks_df["popularity_score"].isna())
+            | (tracks_df["popularity_score"] <= 0)
+            | (tracks_df["spotify_popularity"] <= 0)
         )
 
         if mask.any():
-            subset = self.tracks_list_df.loc[mask]
-
             # --- Combine weighted components ---
-            if (subset["spotify_popularity"] > 0).any():
+            if bounds["use_spotify"]:
                 # Case: Spotify popularity available
-                a = w_play * total_play_counts_normalized[mask]
-                b = w_listeners * total_listeners_count_normalized[mask]
-                c = w_spotify * spotify_popularity_score_normalized[mask]
+                a = W_PLAY * total_play_counts_normalized[mask]
+                b = W_LISTENERS * total_listeners_count_normalized[mask]
+                c = W_SPOTIFY * spotify_popularity_score_normalized[mask]
                 combined = a + b + c
             else:
                 # Case: Spotify popularity not available
-                a = w_play * total_play_counts_normalized[mask]
-                b = w_listeners_1 * total_listeners_count_normalized[mask]
+                a = W_PLAY * total_play_counts_normalized[mask]
+                b = W_LISTENERS_1 * total_listeners_count_normalized[mask]
                 combined = a + b
 
             # --- Normalize the combined score ---
-            combined_scaled = mnmx_scaler.fit_transform(combined)
+            combined_scaled = minMaxScale(combined, bounds["combined"])
 
             # --- Convert to 1–100 scale ---
             popularity_new = 1 + np.around(99 * combined_scaled)
 
             # --- Update DataFrame ---
-            self.tracks_list_df.loc[mask, "popularity_score"] = popularity_new.flatten()
+            tracks_df.loc[mask, "popularity_score"] = popularity_new.flatten()
 
-        self.tracks_list_df["years_normalized"] = years_normalized
-        self.tracks_list_df["duration_normalized"] = duration_normalized
-        self.tracks_list_df["total_play_counts_normalized"] = (
-            total_play_counts_normalized
-        )
-        self.tracks_list_df["total_listeners_count_normalized"] = (
-            total_listeners_count_normalized
-        )
-        self.tracks_list_df["spotify_popularity_score_normalized"] = (
+        tracks_df["years_normalized"] = years_normalized
+        tracks_df["duration_normalized"] = duration_normalized
+        tracks_df["total_play_counts_normalized"] = total_play_counts_normalized
+        tracks_df["total_listeners_count_normalized"] = total_listeners_count_normalized
+        tracks_df["spotify_popularity_score_normalized"] = (
             spotify_popularity_score_normalized
         )
-        self.tracks_list_df["popularity_normalized"] = mnmx_scaler.fit_transform(
-            self.tracks_list_df["popularity_score"].values.reshape(-1, 1)
+        tracks_df["popularity_normalized"] = minMaxScale(
+            tracks_df["popularity_score"], bounds["popularity_score"]
         )
 
-    def generateEmbeddings(
-        self,
-    ):
-        self.createNumericalEmbeddings()
-        self.createTextualEmbeddings()
+    def generateEmbeddings(self, tracks_df):
+        self.createNumericalEmbeddings(tracks_df)
+        textual_embeddings = self.createTextualEmbeddings(tracks_df)
 
         numeric_features = (
-            self.tracks_list_df[
+            tracks_df[
                 [
                     "years_normalized",
                     "duration_normalized",
@@ -188,68 +403,67 @@ class EmbeddingsOps:
             .values
         )
 
-        textual_norm = normalize(self.textual_embeddings)
-
-        # self.embeddings = np.concatenate(
-        #     (
-        #         self.textual_embeddings,
-        #         self.tracks_list_df[["years_normalized"]],
-        #         self.tracks_list_df[["duration_normalized"]],
-        #         self.tracks_list_df[["total_play_counts_normalized"]],
-        #         self.tracks_list_df[["total_listeners_count_normalized"]],
-        #         self.tracks_list_df[["popularity_normalized"]],
-        #     ),
-        #     axis=1,
-        # )
-
-        self.embeddings = np.concatenate((textual_norm, numeric_features), axis=1)
-        self.embeddings = normalize(self.embeddings)
-
-    def storeEmbeddingsInFile(self):
-        self.tracks_list_df[
-            ["song_id", "spotify_id", "lastfm_id", "embeddings"]
-        ].to_csv(
-            "data/processed/embeddings_"
-            + datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-            + ".csv",
-            index=False,
+        textual_norm = normalize(textual_embeddings)
+
+        embeddings = np.concatenate((textual_norm, numeric_features), axis=1)
+        return normalize(embeddings)
+
+    def storeEmbeddingsInFile(self, tracks_df):
+        """Appends the chunk to this run's CSV files, the header is written with the first chunk"""
+        embeddings_path = "data/processed/embeddings_" + self.file_stamp + ".csv"
+        tracks_path = "data/processed/tracks_data_" + self.file_stamp + ".csv"
+        first_chunk = self.tracks_file_columns is None
+
+        tracks_df[["song_id", "spotify_id", "lastfm_id", "embeddings"]].to_csv(
+            embeddings_path, mode="a", header=first_chunk, index=False
         )
-        self.tracks_list_df.drop(columns=["embeddings"]).to_csv(
-            "data/processed/tracks_data_"
-            + datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-            + ".csv",
-            index=False,
+
+        # chunks may not all have the same fields, the first one fixes the columns
+        if first_chunk:
+            self.tracks_file_columns = tracks_df.columns.drop("embeddings")
+        tracks_df.reindex(columns=self.tracks_file_columns).to_csv(
+            tracks_path, mode="a", header=first_chunk, index=False
         )
 
-    def storeEmbeddingsInDatabase(self):
+    def storeEmbeddingsInDatabase(self, tracks_df):
         now = datetime.now()
         formatted_timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        self.tracks_list_df["updatedAt"] = formatted_timestamp
-
-        ndf = self.tracks_list_df[
-            ["song_id", "spotify_id", "lastfm_id", "embeddings", "updatedAt"]
-        ]
-        ndf["embeddings"] = ndf["embeddings"].apply(lambda row: row.tolist())
-
-        df_dict = ndf.to_dict(orient="records")
-        print(len(df_dict))
+        ndf = tracks_df[["song_id", "spotify_id", "lastfm_id", "embeddings"]].copy()
+        ndf["updatedAt"] = formatted_timestamp
+        ndf["embeddings"] = ndf["embeddings"].apply(
+            lambda row: encodeEmbedding(row, self.embeddings_format)
+        )
 
         bulk_request = []
 
-        for t in df_dict:
+        for t in ndf.to_dict(orient="records"):
             bulk_request.append(
                 UpdateOne({"song_id": t["song_id"]}, {"$set": t}, upsert=True)
             )
 
-        res = self.embeddings_collection.bulk_write(bulk_request)
+        if bulk_request:
+            self.embeddings_collection.bulk_write(bulk_request, ordered=False)
+
+    def storeEmbeddingsInSnapshot(self):
+        """
+        Writes the memory mapped snapshot the recommender workers start from. The
+        songs of this run are read back from the collection, nothing is kept for it.
+        """
+        if not self.snapshot_dir or self.rows == 0:
+            return
+
+        if self.rows > SNAPSHOT_MERGE_LIMIT:
+            # a merge holds the changed songs in memory, a rebuild streams them
+            rebuildSnapshot(self.snapshot_dir, self.embeddings_collection)
+            return
 
-    def updateTracksWithEmbeddingStatus(self):
-        df_dict = self.tracks_list_df.to_dict(orient="records")
+        updateSnapshot(self.snapshot_dir, self.embeddings_collection)
+
+    def updateTracksWithEmbeddingStatus(self, tracks_df):
         bulk_request = []
 
-        for t in df_dict:
-            print("t is: ", t)
+        for t in tracks_df[["song_id", "popularity_score"]].to_dict(orient="records"):
             bulk_request.append(
                 UpdateOne(
                     {"song_id": t["song_id"]},
@@ -263,36 +477,130 @@ class EmbeddingsOps:
                 )
             )
 
-        res = self.tracks_collection.bulk_write(bulk_request)
+        if bulk_request:
+            self.tracks_collection.bulk_write(bulk_request, ordered=False)
+
+    def failed(self, stage, e):
+        print("Exception in the ", stage, " stage of updating embeddings: ", e)
+        self.errors.append(e)
+        self.stopped.set()
+
+    def readStage(self, read_queue):
+        try:
+            started = time.perf_counter()
+            for tracks_df in self.getTracksFromDb():
+                tracks_df = self.sanitizeDataframe(tracks_df)
+                self.timings["read"] += time.perf_counter() - started
+                if not putUnlessStopped(read_queue, tracks_df, self.stopped):
+                    return
+                started = time.perf_counter()
+        except Exception as e:
+            self.failed("read", e)
+        finally:
+            putUnlessStopped(read_queue, END_OF_STAGE, self.stopped)
+
+    def writeStage(self, write_queue):
+        while True:
+            tracks_df = write_queue.get()
+            if tracks_df is END_OF_STAGE:
+                return
+            if self.stopped.is_set():
+                continue
+            try:
+                started = time.perf_counter()
+                self.storeEmbeddingsInFile(tracks_df)
+                self.storeEmbeddingsInDatabase(tracks_df)
+                self.updateTracksWithEmbeddingStatus(tracks_df)
+                self.rows += len(tracks_df)
+                self.timings["write"] += time.perf_counter() - started
+                print("embeddings written for ", self.rows, " tracks")
+            except Exception as e:
+                self.failed("write", e)
+
+    def encodeStage(self, read_queue, write_queue):
+        try:
+            while True:
+                tracks_df = getUnlessStopped(read_queue, self.stopped)
+                if tracks_df is END_OF_STAGE:
+                    return
+
+                started = time.perf_counter()
+                embeddings = self.generateEmbeddings(tracks_df)
+                # add embeddings to the dataframe
+                tracks_df["embeddings"] = [emb for emb in embeddings]
+                self.timings["encode"] += time.perf_counter() - started
+
+                if not putUnlessStopped(write_queue, tracks_df, self.stopped):
+                    return
+        except Exception as e:
+            self.failed("encode", e)
 
     def start(self):
         try:
             print("starting")
+            started = time.perf_counter()
 
-            self.getTracksFromDb()
-
-            print("data loaded from db")
-
-            self.sanitizeDataframe()
-            print("dataframe sanitized")
-            # get the embeddings
-            print("concatenating the embeddings")
-            self.generateEmbeddings()
-
-            # add embeddings to the dataframe
-            print("adding embeddings to the dataframe")
-            self.tracks_list_df["embeddings"] = [emb for emb in self.embeddings]
-
-            # store embeddings in the file
-            self.storeEmbeddingsInFile()
-
-            print("embeddings stored in file")
-
-            # store embeddings in database
-            self.storeEmbeddingsInDatabase()
-            print("embeddinsg stored in db")
+            self.scaling_bounds = getScalingBounds(
+                self.tracks_collection, self.tracksQuery()
+            )
+            print("scaling bounds: ", self.scaling_bounds)
+
+            if self.encode_workers > 1 and self.model_name:
+                self.encoding_pool = EncodingPool(
+                    self.model_name,
+                    self.encode_workers,
+                    self.embeddingModel.max_seq_length,
+                    self.encode_batch_size,
+                    self.encode_threads,
+                )
+                self.text_encoder = self.encoding_pool
+            self.file_stamp = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
 
-            # update tracks db for embedding status
-            self.updateTracksWithEmbeddingStatus()
+            read_queue = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+            write_queue = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+            reader = threading.Thread(
+                target=self.readStage, args=(read_queue,), name="embeddings-read"
+            )
+            writer = threading.Thread(
+                target=self.writeStage, args=(write_queue,), name="embeddings-write"
+            )
+            reader.start()
+            writer.start()
+
+            # encoding runs here, between the reader and the writer
+            self.encodeStage(read_queue, write_queue)
+
+            write_queue.put(END_OF_STAGE)
+            writer.join()
+            # unblocks the reader if encoding stopped early
+            self.stopped.set()
+            reader.join()
+
+            if self.errors:
+                raise self.errors[0]
+
+            # store embeddings in the snapshot file
+            self.storeEmbeddingsInSnapshot()
+            print("embeddings snapshot updated")
+
+            elapsed = time.perf_counter() - started
+            print(
+                "embeddings updated for ",
+                self.rows,
+                " tracks in ",
+                elapsed,
+                " (",
+                self.rows / elapsed if elapsed else 0,
+                " tracks/s), stage seconds: ",
+                self.timings,
+            )
+            print("text encoding: ", self.text_encoder.report())
+            if self.embedding_cache is not None:
+                print("text embeddings cache: ", self.embedding_cache.report())
         except Exception as e:
             print("Exception in updatingg embeddings: ", e)
+            # the caller must not reload a catalog that was only partly written
+            raise
+        finally:
+            if self.encoding_pool is not None:
+                self.encoding_pool.close()
@@ -8,6 +8,8 @@ import regex as re
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 
+from database.normalize import splitTags
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -51,6 +53,8 @@ class Tracks:
         tracks_dataframe["all_tags"] = tracks_dataframe["all_tags"].str.replace(
             "_", ","
         )
+        # all_tags stays the display string, tags is what queries and indexes use
+        tracks_dataframe["tags"] = tracks_dataframe["all_tags"].apply(splitTags)
 
         if "spotify_id" not in columns_list:
             tracks_dataframe["spotify_id"] = ""
@@ -0,0 +1,53 @@
+"""Here, I rewrite the embeddings stored as arrays of doubles as packed float32 binary vectors (or back)"""
+
+import time
+from pymongo import UpdateOne
+
+from database.embeddingsCodec import decodeEmbedding, encodeEmbedding
+
+
+def migrateEmbeddings(embeddings_collection, embeddings_format="binary", batch_size=1000):
+    """
+    Re-encodes every embedding that is not stored in embeddings_format yet,
+    batch_size updates per bulk_write. updatedAt is left alone, the values do not change.
+
+    Returns the number of documents rewritten.
+    """
+    start_time = time.perf_counter()
+    # arrays of doubles are BSON type "array", binary vectors are "binData"
+    stored_type = "array" if embeddings_format == "binary" else "binData"
+    cursor = embeddings_collection.find(
+        {"embeddings": {"$type": stored_type}},
+        projection={"_id": True, "embeddings": True},
+        batch_size=batch_size,
+    )
+
+    migrated = 0
+    bulk_request = []
+    for doc in cursor:
+        encoded = encodeEmbedding(
+            decodeEmbedding(doc["embeddings"]), embeddings_format
+        )
+        bulk_request.append(
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"embeddings": encoded}})
+        )
+        if len(bulk_request) >= batch_size:
+            migrated += embeddings_collection.bulk_write(
+                bulk_request, ordered=False
+            ).modified_count
+            bulk_request = []
+
+    if bulk_request:
+        migrated += embeddings_collection.bulk_write(
+            bulk_request, ordered=False
+        ).modified_count
+
+    print(
+        "embeddings migrated to ",
+        embeddings_format,
+        ": ",
+        migrated,
+        " in ",
+        time.perf_counter() - start_time,
+    )
+    return migrated
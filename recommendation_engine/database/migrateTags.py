@@ -0,0 +1,47 @@
+"""Here, I backfill the normalized tags array on tracks that were stored with only the all_tags display string"""
+
+import time
+from pymongo import UpdateOne
+
+from database.normalize import splitTags
+
+
+def backfillTags(tracks_collection, batch_size=1000, force=False):
+    """
+    Sets tags = splitTags(all_tags) on every track that has no tags field yet
+    (or on every track when force is True), batch_size updates per bulk_write.
+
+    Returns the number of tracks updated.
+    """
+    start_time = time.perf_counter()
+    query = {} if force else {"tags": {"$exists": False}}
+    cursor = tracks_collection.find(
+        query, projection={"_id": True, "all_tags": True}, batch_size=batch_size
+    )
+
+    updated = 0
+    bulk_request = []
+    for doc in cursor:
+        bulk_request.append(
+            UpdateOne(
+                {"_id": doc["_id"]}, {"$set": {"tags": splitTags(doc.get("all_tags"))}}
+            )
+        )
+        if len(bulk_request) >= batch_size:
+            updated += tracks_collection.bulk_write(
+                bulk_request, ordered=False
+            ).modified_count
+            bulk_request = []
+
+    if bulk_request:
+        updated += tracks_collection.bulk_write(
+            bulk_request, ordered=False
+        ).modified_count
+
+    print(
+        "tags backfilled for tracks: ",
+        updated,
+        " in ",
+        time.perf_counter() - start_time,
+    )
+    return updated
@@ -0,0 +1,18 @@
+"""Normalization shared by ingestion and the recommender, so that artist names and tags always match the same way"""
+
+
+def normalizeName(name):
+    if not isinstance(name, str):
+        return ""
+    return " ".join(name.lower().split())
+
+
+def splitTags(all_tags):
+    """'Pop, rock,,Pop ' -> ['pop', 'rock']: lowercased, trimmed, deduplicated, order kept"""
+    if isinstance(all_tags, str):
+        all_tags = all_tags.replace("_", ",").split(",")
+    elif not isinstance(all_tags, (list, tuple)):
+        return list()
+
+    tags = [normalizeName(tag) for tag in all_tags]
+    return list(dict.fromkeys(tag for tag in tags if tag))
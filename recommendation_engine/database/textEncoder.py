@@ -0,0 +1,84 @@
+"""Here, I encode track texts in batches of similar token length, so that a short text is not padded to the length of the longest one in its batch"""
+
+import time
+
+import numpy as np
+
+
+class TextEncoder:
+    """
+    Bulk encoding with a SentenceTransformer.
+
+    - Every text is tokenized once to get its length (truncated at the model's
+      max_seq_length). Texts are sorted longest first and cut into batches of
+      batch_size, so each batch is padded only to its own longest text.
+    - The vectors are put back in the input order. The result is the same as
+      model.encode(texts) up to float rounding, only the padding changes.
+    - Real and padded tokens are counted: report() gives tokens/s and how much
+      of the work was padding.
+    """
+
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = batch_size
+        self.stats = {
+            "texts": 0,
+            "batches": 0,
+            "tokens": 0,
+            "padded_tokens": 0,
+            "seconds": 0.0,
+        }
+
+    def tokenLengths(self, texts):
+        encoded = self.model.tokenizer(
+            texts,
+            add_special_tokens=True,
+            truncation=True,
+            max_length=self.model.get_max_seq_length(),
+            return_attention_mask=False,
+            return_token_type_ids=False,
+        )
+        return np.fromiter(
+            (len(ids) for ids in encoded["input_ids"]), dtype=np.int64, count=len(texts)
+        )
+
+    def encode(self, texts):
+        texts = [str(text) for text in texts]
+        if not texts:
+            return np.zeros(
+                (0, self.model.get_sentence_embedding_dimension()), dtype=np.float32
+            )
+
+        started = time.perf_counter()
+        lengths = self.tokenLengths(texts)
+        order = np.argsort(-lengths, kind="stable")
+
+        embeddings = None
+        for start in range(0, len(texts), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            vectors = self.model.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), vectors.dtype)
+            embeddings[batch] = vectors
+
+            self.stats["batches"] += 1
+            self.stats["padded_tokens"] += int(lengths[batch[0]]) * len(batch)
+
+        self.stats["texts"] += len(texts)
+        self.stats["tokens"] += int(lengths.sum())
+        self.stats["seconds"] += time.perf_counter() - started
+        return embeddings
+
+    def report(self):
+        seconds = self.stats["seconds"]
+        padded = self.stats["padded_tokens"]
+        return dict(
+            self.stats,
+            tokens_per_second=self.stats["tokens"] / seconds if seconds else None,
+            padding_share=1 - self.stats["tokens"] / padded if padded else None,
+        )
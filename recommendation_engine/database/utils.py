@@ -10,6 +10,7 @@ import ast
 from pymongo import MongoClient
 
 from db import MongoConnect
+from normalize import splitTags
 from pathlib import Path
 
 
@@ -216,6 +217,7 @@ def prepareDataFrame(path):
         df.drop(columns=["artist_name"], inplace=True)
 
         df["all_tags"] = df["all_tags"].str.replace("_", ",")
+        df["tags"] = df["all_tags"].apply(splitTags)
 
         if "spotify_id" not in col_names:
             df["spotify_id"] = ""
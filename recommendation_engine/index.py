@@ -5,29 +5,127 @@ from fastapi.middleware.cors import CORSMiddleware
 import pickle as pkl
 import pandas as pd
 from datetime import datetime
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field
 
 from contextlib import asynccontextmanager
 from database.db import MongoConnect
+from database.indexes import ensureIndexes, reportCollectionScans
+from database.migrateTags import backfillTags
+from database.migrateEmbeddings import migrateEmbeddings
 
 from database.insertTracks import Tracks
 from database.insertEmbeddings import EmbeddingsOps
 from database.createEmbeddingForSong import SingleSongEmbedding
+from database.embeddingCache import EmbeddingCache, modelId
+from database.embeddingModel import loadEmbeddingModel
 from recommender.recommendSongsForUser import Recommender
-from sentence_transformers import SentenceTransformer
+from recommender.catalogStore import CatalogStore
+from recommender.catalogSync import CatalogSync
+from recommender.annIndex import buildVectorIndex
+from recommender.batchRecommender import BatchRecommender
+from recommender.centroidTable import CentroidTable
+from recommender.invertedIndex import InvertedIndex
+from recommender.userProfile import AsyncUserProfileLoader, UserProfileLoader
+from recommender.boundedExecutor import BoundedExecutor
+from recommender.quantizer import recallCheck
+from recommender.sharedCatalog import SharedCatalogWatcher, attachSharedCatalog
+from recommender.trackDocs import loadTrackDocs, normalizeTrackDoc
+from recommender.trackDetailsCache import TrackDetailsCache
+from recommender.resultCache import buildResultCache
+from recommender.singleFlight import SingleFlight
+from recommender.precompute import (
+    MemoryRecommendationStore,
+    MongoRecommendationStore,
+    RecommendationPrecomputer,
+)
 
 import os
 from config import settings
 
 
+def loadCatalog(app):
+    """(Re)builds everything derived from the embeddings: catalog matrix, centroids and ANN index"""
+    catalog = None
+    track_docs = None
+    if settings.SHARED_CATALOG_DIR:
+        # published by scripts/catalogSupervisor.py, every worker maps the same segments
+        shared = attachSharedCatalog(settings.SHARED_CATALOG_DIR)
+        if shared is not None:
+            catalog, track_docs = shared
+
+    if catalog is not None:
+        if app.state.use_sample_data != True:
+            # songs embedded one by one since the supervisor published this version
+            catalog.applyUpdatesSince(
+                app.state.embeddings_collection, catalog.updated_at
+            )
+    elif app.state.use_sample_data == True:
+        catalog = CatalogStore.fromDataFrame(app.state.embeddings_collection)
+    else:
+        if settings.EMBEDDINGS_SNAPSHOT_DIR:
+            catalog = CatalogStore.fromSnapshot(settings.EMBEDDINGS_SNAPSHOT_DIR)
+
+        if catalog is None:
+            catalog = CatalogStore.fromCollection(app.state.embeddings_collection)
+        else:
+            # songs embedded one by one since the snapshot was written
+            catalog.applyUpdatesSince(
+                app.state.embeddings_collection, catalog.updated_at
+            )
+
+    if settings.EMBEDDINGS_QUANTIZATION != "none":
+        catalog.quantize(
+            settings.EMBEDDINGS_QUANTIZATION, settings.EMBEDDINGS_SPILL_DIR
+        )
+        app.state.quantization_recall = recallCheck(
+            catalog,
+            settings.RESCORE_CANDIDATES,
+            n_queries=settings.QUANTIZATION_RECALL_QUERIES,
+        )
+
+    if track_docs is None:
+        track_docs = loadTrackDocs(
+            app.state.tracks_collection, app.state.use_sample_data
+        )
+    track_docs = list(track_docs)
+    centroids = CentroidTable.build(catalog, track_docs)
+    inverted_index = InvertedIndex.build(catalog, track_docs)
+    vector_index = buildVectorIndex(catalog, settings)
+
+    with app.state.catalog_sync.lock:
+        # tracks may have changed along with the whole catalog
+        app.state.track_details_cache.clear()
+        app.state.catalog = catalog
+        app.state.centroids = centroids
+        app.state.inverted_index = inverted_index
+        app.state.vector_index = vector_index
+        app.state.catalog_sync.resetMark(catalog.updated_at)
+
+
+def updateSongEmbedding(app, em_song):
+    """Runs the single song embedding job, then applies the new vector to the catalog and centroids"""
+    em_song.start()
+
+    if getattr(em_song, "embeddings", None) is None:
+        return
+
+    app.state.catalog_sync.applyUpsert(
+        em_song.song_id,
+        em_song.embeddings[0],
+        normalizeTrackDoc(em_song.song_details),
+    )
+    print("catalog updated for: ", em_song.song_id)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 
     app.state.use_sample_data = settings.USE_SAMPLE_DATA
 
+    mongo_client = None
+
     if settings.USE_SAMPLE_DATA == True:
-        app.state.embeddings_with_songs = pd.read_json(settings.SAMPLE_EMBEDDINGS_PATH)
         app.state.mongo_client = None
         app.state.tracks_collection = pd.read_json(settings.SAMPLE_TRACKS_PATH)
         app.state.embeddings_collection = pd.read_json(settings.SAMPLE_EMBEDDINGS_PATH)
@@ -40,6 +138,15 @@ async def lifespan(app: FastAPI):
         app.state.user_song_interaction_collection = pd.read_csv(
             settings.SAMPLE_USER_SONG_INTERACTION_PATH
         )
+        # the sample dataframes are in memory, there is no async driver to use
+        app.state.async_tracks_collection = None
+        recommendations_store = MemoryRecommendationStore()
+        app.state.async_profile_loader = AsyncUserProfileLoader(
+            app.state.user_fav_artist_collection,
+            app.state.user_fav_genre_collection,
+            app.state.user_song_interaction_collection,
+            app.state.use_sample_data,
+        )
 
         print("Using sample data for recommendations")
     else:
@@ -52,33 +159,144 @@ async def lifespan(app: FastAPI):
         user_fav_genre_collection = db["userfavgenres"]
         user_song_interaction_collection = db["usersonginteractions"]
 
-        app.state.embeddings_with_songs = embeddings_collection.find().to_list()
+        if settings.ENSURE_INDEXES:
+            ensureIndexes(db)
+            reportCollectionScans(db)
+
         app.state.mongo_client = mongo_client
         app.state.tracks_collection = tracks_collection
         app.state.embeddings_collection = embeddings_collection
-        app.state.embeddings_collection = embeddings_collection
         app.state.user_fav_artist_collection = user_fav_artist_collection
         app.state.user_fav_genre_collection = user_fav_genre_collection
         app.state.user_song_interaction_collection = user_song_interaction_collection
 
+        # the request path uses the async driver so that it never blocks the event loop
+        async_db = MongoConnect.connectAsync(settings.MONGO_URI)["EchoFinder"]
+        app.state.async_tracks_collection = async_db["trackdetails"]
+        recommendations_store = (
+            MemoryRecommendationStore()
+            if settings.PRECOMPUTE_STORE == "memory"
+            else MongoRecommendationStore(
+                db["user_recommendations"], async_db["user_recommendations"]
+            )
+        )
+        app.state.async_profile_loader = AsyncUserProfileLoader(
+            async_db["userfavartists"],
+            async_db["userfavgenres"],
+            async_db["usersonginteractions"],
+            app.state.use_sample_data,
+        )
+
         print("MongoDB connection initialized.")
 
+    app.state.profile_loader = UserProfileLoader(
+        app.state.user_fav_artist_collection,
+        app.state.user_fav_genre_collection,
+        app.state.user_song_interaction_collection,
+        app.state.use_sample_data,
+    )
+
+    # scoring and embedding jobs get their own pools instead of the default threadpool
+    app.state.scoring_executor = BoundedExecutor(
+        settings.SCORING_WORKERS, settings.SCORING_MAX_PENDING, "scoring"
+    )
+    app.state.embedding_executor = BoundedExecutor(
+        settings.EMBEDDING_WORKERS, settings.EMBEDDING_MAX_PENDING, "embedding"
+    )
+
+    # track details of recommended songs, filled on demand
+    app.state.track_details_cache = TrackDetailsCache(
+        settings.TRACK_CACHE_SIZE, settings.TRACK_CACHE_TTL
+    )
+
+    # serialized recommendations per user, None when RESULT_CACHE_BACKEND is "off"
+    app.state.result_cache = buildResultCache(settings)
+    # concurrent /user/recommendSongs calls for one user share one computation
+    app.state.single_flight = SingleFlight() if settings.REQUEST_COALESCING else None
+
+    # top songs of recently active users, computed in the background
+    app.state.precomputer = None
+    if settings.PRECOMPUTE_STORE != "off":
+        app.state.precomputer = RecommendationPrecomputer(
+            app.state,
+            recommendations_store,
+            interval=settings.PRECOMPUTE_INTERVAL,
+            active_window=settings.PRECOMPUTE_ACTIVE_WINDOW,
+            max_age=settings.PRECOMPUTE_MAX_AGE,
+            max_users=settings.PRECOMPUTE_MAX_USERS,
+            batch_size=settings.BATCH_USER_TILE,
+        )
+
+    # applies changed songs to the catalog, also used by the single song endpoint
+    app.state.catalog_sync = CatalogSync(
+        app.state,
+        app.state.embeddings_collection,
+        app.state.tracks_collection,
+        # the sample dataframes never change
+        mode="off" if settings.USE_SAMPLE_DATA == True else settings.CATALOG_SYNC_MODE,
+        interval=settings.CATALOG_SYNC_INTERVAL,
+        reconcile_every=settings.CATALOG_SYNC_RECONCILE_EVERY,
+        track_details_cache=app.state.track_details_cache,
+    )
+
+    # load every embedding once, requests score against this resident matrix
+    loadCatalog(app)
+
     embeddingModel = None
     # for gpu
     # with open(settings.EMBEDDINGS_MODEL, "rb") as f:
     #     embeddingModel = pkl.load(f)
 
-    # for cpu:
-    embeddingModel = SentenceTransformer(settings.EMBEDDINGS_MODEL, device="cpu")
+    # for cpu: the fp32 directory, or the int8 quantized weights when it ends with .pt
+    embeddingModel = loadEmbeddingModel(settings.EMBEDDINGS_MODEL)
+    if settings.ENCODE_MAX_SEQ_LENGTH > 0:
+        # every path that encodes (bulk and single song) truncates the same way
+        embeddingModel.max_seq_length = settings.ENCODE_MAX_SEQ_LENGTH
 
     app.state.embeddingModel = embeddingModel
+
+    # textual vectors of texts encoded before, shared by bulk and single song updates
+    app.state.embedding_cache = None
+    if settings.EMBEDDING_CACHE_PATH:
+        app.state.embedding_cache = EmbeddingCache(
+            settings.EMBEDDING_CACHE_PATH,
+            modelId(settings.EMBEDDINGS_MODEL, embeddingModel.max_seq_length),
+            settings.EMBEDDING_CACHE_MAX_ENTRIES,
+        )
     print("embeddings model loadedd")
 
+    app.state.catalog_sync.start()
+
+    # swaps in every new version the supervisor publishes
+    app.state.shared_catalog_watcher = None
+    if settings.SHARED_CATALOG_DIR:
+        app.state.shared_catalog_watcher = SharedCatalogWatcher(
+            settings.SHARED_CATALOG_DIR,
+            lambda: app.state.catalog.version,
+            lambda: loadCatalog(app),
+            interval=settings.CATALOG_SYNC_INTERVAL,
+        )
+        app.state.shared_catalog_watcher.start()
+
+    if app.state.precomputer is not None:
+        app.state.precomputer.start()
+
     yield  # Let FastAPI run the app
 
     # Shutdown logic (optional)
+    app.state.catalog_sync.stop()
+    if app.state.precomputer is not None:
+        app.state.precomputer.stop()
+    if app.state.shared_catalog_watcher is not None:
+        app.state.shared_catalog_watcher.stop()
+    app.state.scoring_executor.shutdown()
+    app.state.embedding_executor.shutdown()
+    if app.state.embedding_cache is not None:
+        app.state.embedding_cache.close()
+
     if mongo_client:
         mongo_client.close()
+        await MongoConnect.closeAsync()
         print("MongoDB connection closed.")
 
 
@@ -102,6 +320,40 @@ def healthCheck():
     return {"health": "ok"}
 
 
+@app.get("/cacheStats")
+def cacheStats(request: Request):
+    result_cache = request.app.state.result_cache
+    return {
+        "track_details": request.app.state.track_details_cache.report(),
+        "results": result_cache.report() if result_cache is not None else None,
+        "precomputed": (
+            request.app.state.precomputer.report()
+            if request.app.state.precomputer is not None
+            else None
+        ),
+        "coalescing": (
+            request.app.state.single_flight.report()
+            if request.app.state.single_flight is not None
+            else None
+        ),
+        "text_embeddings": (
+            request.app.state.embedding_cache.report()
+            if request.app.state.embedding_cache is not None
+            else None
+        ),
+    }
+
+
+@app.post("/user/invalidateRecommendations")
+async def invalidateRecommendations(userId: str, request: Request):
+    """Called after the user's favourite artists, genres or liked songs are written"""
+    if request.app.state.result_cache is not None:
+        await request.app.state.result_cache.invalidateUser(userId)
+    if request.app.state.precomputer is not None:
+        await request.app.state.precomputer.invalidateUser(userId)
+    return {"message": "Recommendations invalidated"}
+
+
 @app.post("/updateEmbeddings")
 def updateEmbeddings(trackId: str, request: Request, background_tasks: BackgroundTasks):
     try:
@@ -112,9 +364,16 @@ def updateEmbeddings(trackId: str, request: Request, background_tasks: Backgroun
             request.app.state.tracks_collection,
             request.app.state.embeddings_collection,
             request.app.state.embeddingModel,
+            settings.EMBEDDINGS_FORMAT,
+            request.app.state.embedding_cache,
         )
 
-        background_tasks.add_task(em_song.start)
+        background_tasks.add_task(
+            request.app.state.embedding_executor.run,
+            updateSongEmbedding,
+            request.app,
+            em_song,
+        )
 
         return {"message": "Embedding update scheduled"}
     except Exception as e:
@@ -132,12 +391,58 @@ def updateTracksDb(request: Request):
         )
 
         tracks.start()
+
+        # keep the posting lists in step with the newly ingested tracks
+        with request.app.state.catalog_sync.lock:
+            for doc in tracks.tracks_df[["song_id", "artists", "tags"]].to_dict(
+                orient="records"
+            ):
+                request.app.state.inverted_index.addTrack(normalizeTrackDoc(doc))
+            # candidates and track details changed: cached results are out of date
+            request.app.state.catalog.revision += 1
+        request.app.state.track_details_cache.invalidate(tracks.tracks_df["song_id"])
     except Exception as e:
         print("exception while insretinmg tracks in database: ", e)
 
 
+@app.get("/migrateTags")
+def migrateTags(request: Request, force: bool = False):
+    """Backfills the normalized tags array on tracks stored before it existed"""
+    try:
+        updated = backfillTags(request.app.state.tracks_collection, force=force)
+        return {"message": "Tags backfilled", "updated": updated}
+    except Exception as e:
+        print("Error while backfilling tags: ", e)
+        return {"message": "Tags backfill failed"}
+
+
+@app.get("/migrateEmbeddings")
+def migrateEmbeddingsFormat(request: Request, embeddingsFormat: str = "binary"):
+    """Rewrites the stored embeddings in the given format ("binary" or "array")"""
+    try:
+        migrated = migrateEmbeddings(
+            request.app.state.embeddings_collection, embeddingsFormat
+        )
+        return {"message": "Embeddings migrated", "migrated": migrated}
+    except Exception as e:
+        print("Error while migrating embeddings: ", e)
+        return {"message": "Embeddings migration failed"}
+
+
+def updateEmbeddingsForAllSongs(app, embeddings):
+    embeddings.start()
+
+    if embeddings.forceUpdate != "true" and app.state.catalog_sync.mode != "off":
+        # only the pending songs changed, apply just those
+        app.state.catalog_sync.pollOnce()
+        return
+
+    # the whole catalog may have changed, so rebuild everything derived from it
+    loadCatalog(app)
+
+
 @app.get("/updateEmbeddingsDb")
-def updateEmbeddingsDb(forceUpdate: str, request: Request):
+async def updateEmbeddingsDb(forceUpdate: str, request: Request):
     try:
         print("trying to update embeddings database")
         embeddings = EmbeddingsOps(
@@ -145,77 +450,130 @@ def updateEmbeddingsDb(forceUpdate: str, request: Request):
             request.app.state.tracks_collection,
             request.app.state.embeddingModel,
             forceUpdate,
+            settings.EMBEDDINGS_SNAPSHOT_DIR,
+            settings.EMBEDDINGS_FORMAT,
+            settings.EMBEDDINGS_CHUNK_SIZE,
+            settings.ENCODE_BATCH_SIZE,
+            request.app.state.embedding_cache,
+            settings.ENCODE_WORKERS,
+            settings.EMBEDDINGS_MODEL,
+            settings.ENCODE_THREADS_PER_WORKER,
         )
 
-        embeddings.start()
+        await request.app.state.embedding_executor.run(
+            updateEmbeddingsForAllSongs, request.app, embeddings
+        )
         return {"status": "done"}
     except Exception as e:
         print("exception while insretinmg embeddings in database: ", e)
+        raise HTTPException(status_code=500, detail="Updating embeddings failed")
+
+
+async def recommendationsBody(state, userId):
+    """The serialized top songs of a user: precomputed, from the result cache or from the full pipeline"""
+    profile = await state.async_profile_loader.load(userId)
+
+    # read before scoring: a result is never stored under a newer catalog version
+    catalog = state.catalog
+    catalog_version = catalog.catalogVersion()
+    if state.precomputer is not None:
+        # a single lookup when the background job computed this user from the same profile and catalog
+        body = await state.precomputer.getFresh(userId, profile, catalog_version)
+        if body is not None:
+            return body
+
+    if state.result_cache is not None:
+        cached = await state.result_cache.get(profile, catalog_version)
+        if cached is not None:
+            return cached
+
+    rec_class = Recommender(
+        userId,
+        state.tracks_collection,
+        catalog,
+        state.centroids,
+        state.inverted_index,
+        state.embeddingModel,
+        state.profile_loader,
+        state.use_sample_data,
+        state.vector_index,
+        settings.RESCORE_CANDIDATES,
+        state.track_details_cache,
+    )
+
+    rec_class.setProfile(profile)
+    await state.scoring_executor.run(rec_class.score)
+    hydrated = await rec_class.getSimilarSongsAsync(state.async_tracks_collection)
+
+    # the records hold plain python values only, so they go straight to orjson
+    # instead of through jsonable_encoder
+    body = ORJSONResponse({"top_songs": rec_class.recommendations}).body
+    # scores without track details are served this once, never cached
+    if hydrated and state.result_cache is not None:
+        await state.result_cache.set(profile, catalog_version, body)
+    return body
 
 
 @app.get("/user/recommendSongs")
-def getRecommendations(userId: str, request: Request):
-    res = None
+async def getRecommendations(userId: str, request: Request):
     print("WIll try to provide recommendations for: ", userId)
     try:
-        rec_class = Recommender(
-            userId,
-            request.app.state.tracks_collection,
-            request.app.state.embeddings_collection,
-            request.app.state.embeddingModel,
-            request.app.state.user_fav_artist_collection,
-            request.app.state.user_fav_genre_collection,
-            request.app.state.user_song_interaction_collection,
-            request.app.state.use_sample_data,
-        )
-
-        rec_ids = rec_class.start()
-        res = rec_class.recommendations
-
-        return {
-            "top_songs": res[
-                [
-                    "song_id",
-                    "sim_score",
-                    "bonus_score",
-                    "final_score",
-                    "popularity_score",
-                    "release",
-                    "spotify_id",
-                    "spotify_popularity",
-                    "title",
-                    "artistsName",
-                    "_id",
-                    "image",
-                ]
-            ].to_dict(orient="records")
-        }
+        state = request.app.state
+        if state.single_flight is None:
+            body = await recommendationsBody(state, userId)
+        else:
+            # duplicate calls for the same user (focus plus refetch) share one run
+            body = await state.single_flight.run(
+                userId, lambda: recommendationsBody(state, userId)
+            )
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         print("exception while providing recommendations: ", e)
-        if res != None:
-            JSONResponse(
-                content={
-                    "top_songs": jsonable_encoder(
-                        res[
-                            [
-                                "song_id",
-                                "sim_score",
-                                "bonus_score",
-                                "final_score",
-                                "popularity_score",
-                                "release",
-                                "spotify_id",
-                                "spotify_popularity",
-                                "title",
-                                "wiki_summary",
-                                "year",
-                            ]
-                        ].to_dict(orient="records")
-                    )
-                }
-            )
-        else:
-            return {"error": "Internal Server Error"}
+        return {"error": "Internal Server Error"}
+
+
+class BatchRecommendationsRequest(BaseModel):
+    # bounded, so one request cannot occupy the scoring pool for long
+    userIds: List[str] = Field(max_length=settings.BATCH_MAX_USERS)
+    topK: int = Field(40, ge=1, le=settings.BATCH_MAX_TOP_K)
+
+
+def newBatchRecommender(app, user_ids, top_k=40):
+    return BatchRecommender(
+        user_ids,
+        app.state.catalog,
+        app.state.centroids,
+        app.state.inverted_index,
+        app.state.profile_loader,
+        top_k=top_k,
+        user_tile=settings.BATCH_USER_TILE,
+        catalog_tile=settings.BATCH_CATALOG_TILE,
+    )
+
+
+def recommendSongsForUsers(app, user_ids, top_k=40):
+    """Top k songs for every user in user_ids, scored together against the catalog"""
+    return newBatchRecommender(app, user_ids, top_k).start()
+
+
+@app.post("/user/recommendSongsBatch")
+async def getRecommendationsBatch(body: BatchRecommendationsRequest, request: Request):
+    print("WIll try to provide recommendations for users: ", len(body.userIds))
+    try:
+        state = request.app.state
+        profiles = await state.async_profile_loader.loadMany(body.userIds)
+        batch = newBatchRecommender(request.app, body.userIds, body.topK)
+
+        return ORJSONResponse(
+            {
+                "recommendations": await state.scoring_executor.run(
+                    batch.scoreProfiles, profiles
+                )
+            }
+        )
+    except Exception as e:
+        print("exception while providing batch recommendations: ", e)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
 # To run: uvicorn server.main:app --host 0.0.0.0 --port 8000 --reload
@@ -0,0 +1,162 @@
+"""Here, I build an approximate nearest neighbour index over the catalog so that a request does not have to score every song"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def catalogFingerprint(song_ids):
+    """Hash of the catalog row order, so that a saved index is never used with a different catalog"""
+    digest = hashlib.sha1()
+    for song_id in song_ids:
+        digest.update(str(song_id).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def unitRows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-8)
+
+
+class IVFFlatIndex:
+    """
+    Inverted file index with flat (uncompressed) lists.
+
+    - build() clusters the unit-normalized embeddings with spherical k-means.
+    - Each song row is stored in the list of its closest centroid.
+    - search() probes the n_probe closest lists and scores every row in them
+      against the catalog matrix. n_probe is the recall/latency knob.
+    - Rows added or changed after the build are kept in extra_rows and scored on
+      every search, until the index is built again.
+    """
+
+    def __init__(self, catalog, n_lists=0, n_probe=8, shortlist_size=400):
+        self.catalog = catalog
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.shortlist_size = shortlist_size
+        self.centroids = None
+        # rows of each list are stored back to back, list i is order[offsets[i]:offsets[i + 1]]
+        self.order = None
+        self.offsets = None
+        self.extra_rows = np.zeros((0,), dtype=np.int64)
+
+    def defaultListCount(self):
+        return max(1, int(np.sqrt(self.catalog.size)))
+
+    def assign(self, block_size=8192):
+        """Closest centroid of every catalog row"""
+        assignments = np.empty((self.catalog.size,), dtype=np.int64)
+        for start in range(0, self.catalog.size, block_size):
+            end = min(start + block_size, self.catalog.size)
+            block = unitRows(self.catalog.block(start, end))
+            assignments[start:end] = np.argmax(block @ self.centroids.T, axis=1)
+        return assignments
+
+    def build(self, n_iter=10, sample_size=None, seed=42):
+        n_rows = self.catalog.size
+        n_lists = min(self.n_lists or self.defaultListCount(), n_rows)
+        rng = np.random.default_rng(seed)
+
+        # k-means only needs a sample of the catalog to place the centroids
+        sample_size = sample_size or min(n_rows, n_lists * 64)
+        sample_rows = np.sort(rng.choice(n_rows, size=sample_size, replace=False))
+        sample = unitRows(self.catalog.vectors(sample_rows))
+
+        self.centroids = sample[rng.choice(sample_size, size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ self.centroids.T, axis=1)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=n_lists) == 0
+            # an empty cluster keeps its old centroid instead of collapsing to zero
+            sums[empty] = self.centroids[empty]
+            self.centroids = unitRows(sums).astype(np.float32)
+
+        assignments = self.assign()
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.zeros((n_lists + 1,), dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=self.offsets[1:])
+        self.n_lists = n_lists
+
+        print("ann index built with lists: ", n_lists)
+        return self
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # every worker may build at startup: each writes its own file and renames it into place,
+        # so a reader never sees a half written one (a file object keeps savez from adding .npz)
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                order=self.order,
+                offsets=self.offsets,
+                fingerprint=np.array(catalogFingerprint(self.catalog.song_ids)),
+            )
+        os.replace(tmp_path, path)
+        print("ann index saved at: ", path)
+
+    def load(self, path):
+        """Loads a saved index, returns False if it does not exist or was built for another catalog"""
+        if not os.path.exists(path):
+            return False
+
+        with np.load(path) as saved:
+            if str(saved["fingerprint"]) != catalogFingerprint(self.catalog.song_ids):
+                print("ann index at ", path, " is stale")
+                return False
+            self.centroids = saved["centroids"]
+            self.order = saved["order"]
+            self.offsets = saved["offsets"]
+
+        self.n_lists = self.centroids.shape[0]
+        print("ann index loaded from: ", path)
+        return True
+
+    def candidateRows(self, query, n_probe=None):
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        centroid_scores = self.centroids @ query
+        probed_lists = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        rows = np.concatenate(
+            [self.order[self.offsets[i] : self.offsets[i + 1]] for i in probed_lists]
+        )
+        extra_rows = self.extra_rows
+        return np.union1d(rows, extra_rows) if len(extra_rows) else rows
+
+    def addRows(self, rows):
+        """Rows that were appended or changed since the build, they are searched on every query"""
+        self.extra_rows = np.union1d(self.extra_rows, rows)
+
+    def search(self, query, k=None, n_probe=None):
+        """Returns the rows of the (approximately) k most similar songs"""
+        k = k or self.shortlist_size
+        query = np.nan_to_num(np.asarray(query, dtype=np.float32), nan=0.0)
+
+        rows = self.candidateRows(query, n_probe)
+        if len(rows) <= k:
+            return rows
+
+        # scores everything in the probed lists, on the quantized matrix if the catalog has one
+        return self.catalog.shortlist(query, k, rows)
+
+
+def buildVectorIndex(catalog, settings):
+    """Returns the ANN index for the configured search mode, or None for exact search"""
+    if settings.SEARCH_MODE != "ann":
+        print("using exact search")
+        return None
+
+    index = IVFFlatIndex(
+        catalog,
+        n_lists=settings.ANN_N_LISTS,
+        n_probe=settings.ANN_N_PROBE,
+        shortlist_size=settings.ANN_SHORTLIST_SIZE,
+    )
+    if not index.load(settings.ANN_INDEX_PATH):
+        index.build()
+        index.save(settings.ANN_INDEX_PATH)
+    return index
@@ -0,0 +1,172 @@
+"""Here, I score many users at once (for the nightly email and push jobs) with blocked matrix multiplies"""
+
+import numpy as np
+
+from recommender.ranking import BONUS_PER_MATCH, preferenceVector
+
+
+class BatchRecommender:
+    """
+    Recommends top_k songs for every user in user_ids.
+
+    - User profiles are fetched with one $in query per collection for the whole batch
+      instead of one set of queries per user, candidates come from the inverted index.
+    - Scores are computed as (user tile) x (catalog tile) matrix products, so peak memory
+      is user_tile * catalog_tile floats no matter how many users or songs there are.
+    - A user whose preferences match no song gets an empty list, where the single user
+      endpoint fails with "No candidate tracks".
+    """
+
+    def __init__(
+        self,
+        user_ids,
+        catalog,
+        centroids,
+        inverted_index,
+        profile_loader,
+        top_k=40,
+        user_tile=256,
+        catalog_tile=16384,
+    ):
+        self.user_ids = list(dict.fromkeys(user_ids))
+        self.catalog = catalog
+        self.centroids = centroids
+        self.inverted_index = inverted_index
+        self.profile_loader = profile_loader
+        self.top_k = top_k
+        self.user_tile = user_tile
+        self.catalog_tile = catalog_tile
+
+    def fetchUserDetails(self):
+        self.profiles = self.profile_loader.loadMany(self.user_ids)
+        print("fetched preferences for users: ", len(self.user_ids))
+
+    def buildUserVectors(self):
+        self.user_vectors = np.zeros(
+            (len(self.user_ids), self.catalog.dim), dtype=np.float32
+        )
+        # per user: catalog rows that get a bonus and how much bonus they get
+        self.bonus_rows = list()
+        self.bonus_values = list()
+
+        for i, user_id in enumerate(self.user_ids):
+            profile = self.profiles[user_id]
+            fav_artists_rows = self.inverted_index.rowsFor(
+                "artist", profile.fav_artists
+            )
+            fav_genres_rows = self.inverted_index.rowsFor("tag", profile.fav_genres)
+            liked_songs_rows = self.catalog.rowsFor(profile.liked_songs)
+
+            self.user_vectors[i] = preferenceVector(
+                self.catalog,
+                self.centroids,
+                profile.fav_artists,
+                profile.fav_genres,
+                liked_songs_rows,
+            )
+
+            rows, matches = np.unique(
+                np.concatenate([fav_artists_rows, fav_genres_rows, liked_songs_rows]),
+                return_counts=True,
+            )
+            self.bonus_rows.append(rows)
+            self.bonus_values.append((BONUS_PER_MATCH * matches).astype(np.float32))
+
+    def scoreUserTile(self, user_start, user_end):
+        """Running top_k over catalog tiles for users[user_start:user_end]"""
+        queries = self.user_vectors[user_start:user_end]
+        query_norms = np.linalg.norm(queries, axis=1)
+        queries = queries / np.maximum(query_norms, 1e-8)[:, None]
+        n_users = queries.shape[0]
+
+        best_scores = np.full((n_users, 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((n_users, 0), dtype=np.int64)
+
+        for start in range(0, self.catalog.size, self.catalog_tile):
+            end = min(start + self.catalog_tile, self.catalog.size)
+            tile_norms = np.maximum(self.catalog.normsBlock(start, end), 1e-8)
+            scores = (queries @ self.catalog.block(start, end).T) / tile_norms
+            scores[:, self.catalog.deadRowsIn(start, end) - start] = -np.inf
+
+            for i in range(n_users):
+                rows = self.bonus_rows[user_start + i]
+                in_tile = (rows >= start) & (rows < end)
+                scores[i, rows[in_tile] - start] += self.bonus_values[user_start + i][
+                    in_tile
+                ]
+
+            # keep only the top_k of this tile before merging with the best so far
+            k = min(self.top_k, end - start)
+            tile_top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            merged_scores = np.concatenate(
+                [best_scores, np.take_along_axis(scores, tile_top, axis=1)], axis=1
+            )
+            merged_rows = np.concatenate([best_rows, tile_top + start], axis=1)
+
+            k = min(self.top_k, merged_scores.shape[1])
+            keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_rows, order, axis=1)
+
+    def recordsFor(self, user_index, rows):
+        """Response records with the same score columns as the single user endpoint"""
+        sim_scores = self.catalog.cosineScores(self.user_vectors[user_index], rows)
+        bonus = dict(
+            zip(
+                self.bonus_rows[user_index].tolist(),
+                self.bonus_values[user_index].tolist(),
+            )
+        )
+
+        records = list()
+        song_ids = self.catalog.songIdsOf(rows)
+        for row, song_id, sim_score in zip(
+            rows.tolist(), song_ids, sim_scores.tolist()
+        ):
+            if not np.isfinite(sim_score):
+                # a deleted song, only here when fewer than top_k songs are left
+                continue
+            bonus_score = bonus.get(row, 0.0)
+            records.append(
+                {
+                    "song_id": song_id,
+                    "sim_score": sim_score,
+                    "bonus_score": bonus_score,
+                    "final_score": sim_score + bonus_score,
+                }
+            )
+        return records
+
+    def scoreUsers(self):
+        self.recommendations = dict()
+        if self.catalog.size == 0:
+            return
+
+        for user_start in range(0, len(self.user_ids), self.user_tile):
+            user_end = min(user_start + self.user_tile, len(self.user_ids))
+            top_rows = self.scoreUserTile(user_start, user_end)
+
+            for i in range(user_end - user_start):
+                if len(self.bonus_rows[user_start + i]) == 0:
+                    # no candidate song, the top k would only come from a zero vector
+                    self.recommendations[self.user_ids[user_start + i]] = list()
+                    continue
+                self.recommendations[self.user_ids[user_start + i]] = self.recordsFor(
+                    user_start + i, top_rows[i]
+                )
+
+            print("scored users: ", user_end, "/", len(self.user_ids))
+
+    def scoreProfiles(self, profiles):
+        """The CPU bound part, for callers that already loaded the profiles"""
+        self.profiles = profiles
+        self.buildUserVectors()
+        self.scoreUsers()
+        return self.recommendations
+
+    def start(self):
+        self.fetchUserDetails()
+        return self.scoreProfiles(self.profiles)
@@ -0,0 +1,31 @@
+"""A thread pool for CPU work that the async request path hands off, with a cap on how much work can queue up"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BoundedExecutor:
+    """
+    - max_workers threads run the work (numpy/torch release the GIL in their kernels).
+    - At most max_pending calls are queued or running, further callers wait on the
+      semaphore instead of piling up unbounded work behind the pool.
+    """
+
+    def __init__(self, max_workers, max_pending, name):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self.max_pending = max(max_pending, max_workers)
+        self.semaphore = None
+
+    async def run(self, fn, *args):
+        # created lazily so that it belongs to the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_pending)
+
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,374 @@
+"""Here, I keep every song embedding in memory so that a recommendation does not have to read the whole songs_embeddings collection"""
+
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from database.embeddingsCodec import decodeEmbedding
+from database.embeddingsSnapshot import (
+    TIMESTAMP_FORMAT,
+    loadEmbeddingsFromCollection,
+    readSnapshot,
+)
+from recommender.quantizer import QuantizedMatrix
+
+
+def growBuffer(buffer, capacity):
+    """A copy of buffer with room for capacity rows"""
+    grown = np.zeros((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[: buffer.shape[0]] = buffer
+    return grown
+
+
+class CatalogStore:
+    """
+    Holds the song embeddings as one float32 matrix.
+
+    - song_ids[row] is the song that lives in that row of the matrix.
+    - id_to_row maps a song_id back to its row.
+    - norms are precomputed so that cosine scores are a single matrix-vector product.
+    - Rows 0..base_size-1 live in embeddings, base_norms and base_song_ids (in
+      memory, or memory mapped from a snapshot or spill file), rows appended after
+      loading live in the tail buffers, so that a new song never copies the base
+      arrays. norms and song_ids put the two together.
+    - A read-only base (shared memory) is never written: a song that changes is
+      tombstoned and appended again.
+    - remove() tombstones a row: the song leaves id_to_row and the row always scores
+      -inf, its space is reclaimed by the next full load.
+    - quantize() adds a float16/int8 copy for the first pass scan and can move the
+      float32 matrix to a memory mapped file, so only the rows that get rescored
+      (and the pages the OS decides to keep) stay in memory.
+    """
+
+    def __init__(self, song_ids, embeddings, norms=None, copy=True):
+        # an array that is passed in (e.g. attached from shared memory) is kept as is
+        self.base_song_ids = (
+            song_ids
+            if isinstance(song_ids, np.ndarray)
+            else np.asarray(song_ids, dtype=object)
+        )
+        if copy:
+            embeddings = np.ascontiguousarray(
+                np.nan_to_num(np.asarray(embeddings, dtype=np.float32), nan=0.0)
+            )
+        if embeddings.ndim != 2:
+            # no songs at all
+            embeddings = np.zeros((len(self.base_song_ids), 0), dtype=np.float32)
+        self.embeddings = embeddings
+
+        self.base_norms = (
+            np.linalg.norm(self.embeddings, axis=1)
+            if norms is None
+            else np.asarray(norms, dtype=np.float32)
+        )
+        self.id_to_row = {
+            song_id: row for row, song_id in enumerate(self.base_song_ids)
+        }
+        # rows base_size..size-1, with spare capacity
+        self.tail = np.zeros((0, self.embeddings.shape[1]), dtype=np.float32)
+        self.tail_norms = np.zeros((0,), dtype=np.float32)
+        self.tail_song_ids = np.zeros((0,), dtype=object)
+        self.tail_size = 0
+        # sorted rows of deleted songs
+        self.dead_rows = np.zeros((0,), dtype=np.int64)
+        self.quantized = None
+        self.spill_file = None
+        # True when embeddings, norms and song_ids are read-only shared memory views
+        self.shared = False
+        self.version = None
+        self.updated_at = None
+        # bumped by every change after loading, see catalogVersion()
+        self.revision = 0
+
+    @classmethod
+    def fromCollection(cls, embeddings_collection):
+        # taken before the read, so that nothing written during it is missed later
+        updated_at = datetime.now().strftime(TIMESTAMP_FORMAT)
+        song_ids, embeddings = loadEmbeddingsFromCollection(embeddings_collection)
+        print("catalog loaded from db: ", len(song_ids))
+        # the loader's buffer is already float32 and owned by nobody else
+        embeddings = np.nan_to_num(embeddings, nan=0.0, copy=False)
+        catalog = cls(song_ids, embeddings, copy=False)
+        catalog.updated_at = updated_at
+        return catalog
+
+    @classmethod
+    def fromSnapshot(cls, snapshot_dir):
+        """
+        Memory maps the snapshot written by EmbeddingsOps, or returns None if there is none.
+
+        The mapping is copy-on-write: the file is never modified, workers on one host
+        share its pages, and an in-place update only makes the pages it touches private.
+        """
+        snapshot = readSnapshot(snapshot_dir, mmap_mode="c")
+        if snapshot is None:
+            return None
+
+        manifest, song_ids, embeddings, norms = snapshot
+        catalog = cls(song_ids, embeddings, norms=norms, copy=False)
+        catalog.version = manifest["version"]
+        catalog.updated_at = manifest["updated_at"]
+        print(
+            "catalog mapped from snapshot: ", catalog.version, ", rows: ", catalog.size
+        )
+        return catalog
+
+    def applyUpdatesSince(self, embeddings_collection, updated_at):
+        """Upserts the songs whose embeddings changed at or after updated_at and moves updated_at forward, returns how many"""
+        cursor = embeddings_collection.find(
+            {"updatedAt": {"$gte": updated_at}},
+            projection={
+                "_id": False,
+                "song_id": True,
+                "embeddings": True,
+                "updatedAt": True,
+            },
+        )
+
+        applied = 0
+        for doc in cursor:
+            if doc.get("embeddings"):
+                self.upsert(doc["song_id"], decodeEmbedding(doc["embeddings"]))
+                applied += 1
+            self.updated_at = max(self.updated_at or "", doc.get("updatedAt") or "")
+
+        print("catalog updates applied since ", updated_at, ": ", applied)
+        return applied
+
+    @classmethod
+    def fromDataFrame(cls, embeddings_df):
+        embeddings_df = embeddings_df.dropna(subset=["embeddings"])
+        print("catalog loaded from dataframe: ", embeddings_df.shape[0])
+        return cls(
+            embeddings_df["song_id"].values,
+            embeddings_df["embeddings"].to_list(),
+        )
+
+    def catalogVersion(self):
+        """
+        Identifies what recommendations are computed from: the loaded version, how far
+        updates were applied and how many changes were made since. Two workers that
+        applied the same updates to the same snapshot have the same version.
+        """
+        return str(self.version) + "|" + str(self.updated_at) + "|" + str(self.revision)
+
+    @property
+    def base_size(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def size(self):
+        return self.base_size + self.tail_size
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    @property
+    def norms(self):
+        return self.span(self.base_norms, self.tail_norms, 0, self.size)
+
+    @property
+    def song_ids(self):
+        return self.span(self.base_song_ids, self.tail_song_ids, 0, self.size)
+
+    def quantize(self, mode, spill_dir=None):
+        """Builds the quantized scan matrix, and moves an in-memory float32 matrix to a file in spill_dir if given"""
+        self.quantized = QuantizedMatrix.fromMatrix(self.embeddings, mode)
+        for row in range(self.tail_size):
+            self.quantized.upsert(self.base_size + row, self.tail[row])
+
+        # a memory mapped snapshot or shared memory is already out of the process heap
+        in_memory = not self.shared and not isinstance(self.embeddings, np.memmap)
+        if spill_dir and in_memory and self.base_size > 0:
+            self.spill(spill_dir)
+
+    def spill(self, spill_dir):
+        os.makedirs(spill_dir, exist_ok=True)
+        # an unnamed file: it is private to this process and removed when it exits
+        self.spill_file = tempfile.TemporaryFile(dir=spill_dir)
+        self.spill_file.write(self.embeddings.tobytes())
+        self.spill_file.flush()
+        self.embeddings = np.memmap(
+            self.spill_file,
+            dtype=np.float32,
+            mode="r+",
+            shape=(self.base_size, self.dim),
+        )
+        print("float32 embeddings moved to a memory mapped file in: ", spill_dir)
+
+    def appendRow(self, song_id, vector, norm):
+        if self.tail_size == self.tail.shape[0]:
+            # grow with spare capacity so that appends are amortized O(1)
+            capacity = int(self.tail.shape[0] * 1.5) + 16
+            self.tail = growBuffer(self.tail, capacity)
+            self.tail_norms = growBuffer(self.tail_norms, capacity)
+            self.tail_song_ids = growBuffer(self.tail_song_ids, capacity)
+        self.tail[self.tail_size] = vector
+        self.tail_norms[self.tail_size] = norm
+        self.tail_song_ids[self.tail_size] = song_id
+        # the row exists for readers once all three are written
+        self.tail_size += 1
+
+    def gather(self, base, tail, rows):
+        """Values of the given rows, from a base array and its tail buffer"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.tail_size == 0:
+            return np.asarray(base[rows])
+
+        in_base = rows < self.base_size
+        values = np.empty(rows.shape + base.shape[1:], dtype=np.result_type(base, tail))
+        values[in_base] = base[rows[in_base]]
+        values[~in_base] = tail[rows[~in_base] - self.base_size]
+        return values
+
+    def span(self, base, tail, start, end):
+        """Values of rows start..end-1, from a base array and its tail buffer"""
+        base_size = self.base_size
+        if end <= base_size:
+            return base[start:end]
+        if start >= base_size:
+            return tail[start - base_size : end - base_size]
+        return np.concatenate([base[start:], tail[: end - base_size]], axis=0)
+
+    def vectors(self, rows):
+        """float32 embeddings of the given rows"""
+        return self.gather(self.embeddings, self.tail, rows)
+
+    def block(self, start, end):
+        """float32 embeddings of rows start..end-1"""
+        return self.span(self.embeddings, self.tail, start, end)
+
+    def normsOf(self, rows):
+        return self.gather(self.base_norms, self.tail_norms, rows)
+
+    def normsBlock(self, start, end):
+        return self.span(self.base_norms, self.tail_norms, start, end)
+
+    def songIdsOf(self, rows):
+        return self.gather(self.base_song_ids, self.tail_song_ids, rows)
+
+    def rowsFor(self, song_ids):
+        """Returns the unique rows of the given songs, skipping songs without embeddings"""
+        rows = {
+            self.id_to_row[song_id] for song_id in song_ids if song_id in self.id_to_row
+        }
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
+
+    def vectorFor(self, song_id):
+        row = self.id_to_row.get(song_id)
+        if row is None:
+            return None
+        return np.array(self.block(row, row + 1)[0])
+
+    def upsert(self, song_id, vector):
+        """
+        Replaces the embedding of song_id, or appends it as a new row.
+
+        Requests read the catalog while this runs, so a new row is published in an
+        order where they never see it half added: the tail row with its norm and
+        song_id first, then the quantized row, and id_to_row last.
+        """
+        vector = np.nan_to_num(np.asarray(vector, dtype=np.float32), nan=0.0)
+        row = self.id_to_row.get(song_id)
+
+        if row is None:
+            row = self.size
+            self.appendRow(song_id, vector, np.linalg.norm(vector))
+            if self.quantized is not None:
+                self.quantized.upsert(row, vector)
+            self.id_to_row[song_id] = row
+            self.revision += 1
+            return row
+
+        if row < self.base_size and not self.embeddings.flags.writeable:
+            # shared rows are never written: the song moves to a new row in the tail
+            self.remove(song_id)
+            return self.upsert(song_id, vector)
+
+        if row < self.base_size:
+            self.embeddings[row] = vector
+            self.base_norms[row] = np.linalg.norm(vector)
+        else:
+            self.tail[row - self.base_size] = vector
+            self.tail_norms[row - self.base_size] = np.linalg.norm(vector)
+        if self.quantized is not None:
+            self.quantized.upsert(row, vector)
+        self.revision += 1
+        return row
+
+    def remove(self, song_id):
+        """Tombstones the row of song_id, returns the row or None if the song is unknown"""
+        row = self.id_to_row.pop(song_id, None)
+        if row is not None:
+            self.dead_rows = np.union1d(self.dead_rows, [row])
+            self.revision += 1
+        return row
+
+    def deadRowsIn(self, start, end):
+        """Tombstoned rows in start..end-1"""
+        lo, hi = np.searchsorted(self.dead_rows, [start, end])
+        return self.dead_rows[lo:hi]
+
+    def maskDead(self, scores, rows=None):
+        """Sets the scores of tombstoned rows to -inf, in place"""
+        if len(self.dead_rows) == 0:
+            return scores
+        if rows is None:
+            scores[self.deadRowsIn(0, len(scores))] = -np.inf
+        else:
+            scores[np.isin(rows, self.dead_rows)] = -np.inf
+        return scores
+
+    def cosineScores(self, query, rows=None):
+        """Cosine similarity between the query vector and every song (or only the given rows) in the catalog"""
+        query = np.nan_to_num(np.asarray(query, dtype=np.float32), nan=0.0)
+        query_norm = np.linalg.norm(query)
+
+        if rows is not None:
+            products = self.vectors(rows) @ query
+            norms = self.normsOf(rows)
+        else:
+            tail = self.tail[: self.tail_size]
+            products = self.embeddings @ query
+            if tail.shape[0]:
+                products = np.concatenate([products, tail @ query])
+            norms = self.normsBlock(0, products.shape[0])
+
+        if query_norm == 0:
+            return self.maskDead(np.zeros((products.shape[0],), dtype=np.float32), rows)
+
+        denominator = np.maximum(norms * query_norm, 1e-8)
+        return self.maskDead(products / denominator, rows)
+
+    def scanScores(self, query, rows=None):
+        """First pass scores: from the quantized matrix if there is one, exact cosine scores otherwise"""
+        if self.quantized is None:
+            return self.cosineScores(query, rows)
+
+        query = np.nan_to_num(np.asarray(query, dtype=np.float32), nan=0.0)
+        query_norm = np.linalg.norm(query)
+
+        products = self.quantized.dot(query, rows)
+        norms = (
+            self.normsBlock(0, products.shape[0])
+            if rows is None
+            else self.normsOf(rows)
+        )
+
+        if query_norm == 0:
+            return self.maskDead(np.zeros((products.shape[0],), dtype=np.float32), rows)
+
+        denominator = np.maximum(norms * query_norm, 1e-8)
+        return self.maskDead(products / denominator, rows)
+
+    def shortlist(self, query, k, rows=None):
+        """The k rows (of all rows, or of the given rows) with the best first pass scores"""
+        scores = self.scanScores(query, rows)
+        if len(scores) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+        else:
+            keep = np.arange(len(scores))
+        return keep if rows is None else rows[keep]
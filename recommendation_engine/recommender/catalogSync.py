@@ -0,0 +1,271 @@
+"""Here, I keep the in-memory catalog in step with songs_embeddings by applying only the songs that changed, instead of reloading everything"""
+
+import threading
+
+from pymongo.errors import PyMongoError
+
+from database.embeddingsCodec import decodeEmbedding
+from recommender.trackDocs import loadTrackDocsFor
+
+EMBEDDING_PROJECTION = {
+    "_id": False,
+    "song_id": True,
+    "embeddings": True,
+    "updatedAt": True,
+}
+
+
+class CatalogSync:
+    """
+    Applies changed songs to the catalog, centroids, inverted index and ANN index.
+
+    - "poll" mode asks songs_embeddings for updatedAt >= the high water mark every
+      interval seconds (served by the updatedAt_1 index).
+    - "changestream" mode tails a change stream, which needs a replica set, and
+      falls back to polling when one cannot be opened.
+    - A new song is appended to the catalog, a changed song overwrites its row and a
+      deleted song's row is tombstoned. Neither needs a full rebuild.
+    - A poll cannot see deletes and a delete event only carries the _id, so deleted
+      songs are found by comparing song ids every reconcile_every polls, or once
+      the change stream has no more events after a delete.
+    - Everything that changes the catalog goes through applyUpsert/applyDelete under
+      one lock, the single song endpoint uses them too. The objects are always read
+      from state (app.state) because a full reload replaces them.
+    """
+
+    MODES = ("off", "poll", "changestream")
+
+    def __init__(
+        self,
+        state,
+        embeddings_collection,
+        tracks_collection,
+        mode="poll",
+        interval=5.0,
+        reconcile_every=60,
+        batch_size=500,
+        track_details_cache=None,
+    ):
+        if mode not in self.MODES:
+            raise ValueError("unknown catalog sync mode: " + str(mode))
+
+        self.state = state
+        self.embeddings_collection = embeddings_collection
+        self.tracks_collection = tracks_collection
+        self.mode = mode
+        self.interval = interval
+        self.reconcile_every = reconcile_every
+        self.batch_size = batch_size
+        self.track_details_cache = track_details_cache
+
+        self.lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.high_water_mark = None
+        # songs already applied whose updatedAt equals the high water mark
+        self.seen_at_mark = set()
+        self.stats = {"upserts": 0, "deletes": 0, "polls": 0, "errors": 0}
+
+    def resetMark(self, updated_at):
+        """Called after a full (re)load, changes from updated_at on are not in the catalog yet"""
+        with self.lock:
+            self.high_water_mark = updated_at
+            self.seen_at_mark = set()
+
+    def invalidateDetails(self, song_id):
+        # the embedding job also writes the track (status, popularity)
+        if self.track_details_cache is not None:
+            self.track_details_cache.invalidate([song_id])
+
+    def applyUpsert(self, song_id, vector, track_doc=None):
+        with self.lock:
+            state = self.state
+            old_vector = state.catalog.vectorFor(song_id)
+            row = state.catalog.upsert(song_id, vector)
+
+            if track_doc is not None:
+                state.centroids.updateSong(
+                    song_id,
+                    old_vector,
+                    vector,
+                    track_doc["artists"],
+                    track_doc["tags"],
+                )
+                state.inverted_index.addTrack(track_doc)
+            else:
+                # no track details: keep the keys the song was indexed under, if any
+                keys = state.centroids.song_keys.get(song_id)
+                if keys is not None:
+                    state.centroids.updateSong(
+                        song_id, old_vector, vector, keys["artist"], keys["tag"]
+                    )
+                # the track may have been ingested before its embedding, waiting for a row
+                state.inverted_index.attachRow(song_id)
+
+            if state.vector_index is not None:
+                state.vector_index.addRows([row])
+            self.invalidateDetails(song_id)
+            self.stats["upserts"] += 1
+            return row
+
+    def applyDelete(self, song_id):
+        with self.lock:
+            state = self.state
+            old_vector = state.catalog.vectorFor(song_id)
+            if old_vector is None:
+                return
+
+            state.centroids.removeSong(song_id, old_vector)
+            state.inverted_index.removeTrack(song_id)
+            state.catalog.remove(song_id)
+            self.invalidateDetails(song_id)
+            self.stats["deletes"] += 1
+
+    def applyDocs(self, docs):
+        """Applies a batch of songs_embeddings documents and moves the high water mark"""
+        docs = [doc for doc in docs if doc.get("embeddings")]
+        track_docs = loadTrackDocsFor(
+            self.tracks_collection, {doc["song_id"] for doc in docs}
+        )
+        for doc in docs:
+            self.applyUpsert(
+                doc["song_id"],
+                decodeEmbedding(doc["embeddings"]),
+                track_docs.get(doc["song_id"]),
+            )
+
+        with self.lock:
+            for doc in docs:
+                updated_at = doc.get("updatedAt")
+                if not updated_at or (
+                    self.high_water_mark and updated_at < self.high_water_mark
+                ):
+                    continue
+                if updated_at != self.high_water_mark:
+                    self.high_water_mark = updated_at
+                    self.seen_at_mark = set()
+                self.seen_at_mark.add(doc["song_id"])
+
+    def pollOnce(self):
+        """Applies every song changed since the high water mark, returns how many"""
+        query = (
+            {}
+            if self.high_water_mark is None
+            else {"updatedAt": {"$gte": self.high_water_mark}}
+        )
+        cursor = (
+            self.embeddings_collection.find(query, projection=EMBEDDING_PROJECTION)
+            .sort("updatedAt", 1)
+            .batch_size(self.batch_size)
+        )
+
+        applied = 0
+        batch = list()
+        for doc in cursor:
+            # updatedAt has a one second resolution, skip what was applied in that second
+            if (
+                doc.get("updatedAt") == self.high_water_mark
+                and doc["song_id"] in self.seen_at_mark
+            ):
+                continue
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                self.applyDocs(batch)
+                applied += len(batch)
+                batch = list()
+
+        if batch:
+            self.applyDocs(batch)
+            applied += len(batch)
+
+        self.stats["polls"] += 1
+        if applied:
+            print("catalog sync applied songs: ", applied)
+        return applied
+
+    def reconcileDeletes(self):
+        """Tombstones the songs that are in the catalog but no longer in songs_embeddings"""
+        stored = {
+            doc["song_id"]
+            for doc in self.embeddings_collection.find(
+                {}, projection={"_id": False, "song_id": True}
+            )
+        }
+        deleted = [
+            song_id
+            for song_id in list(self.state.catalog.id_to_row)
+            if song_id not in stored
+        ]
+        for song_id in deleted:
+            self.applyDelete(song_id)
+
+        if deleted:
+            print("catalog sync removed songs: ", len(deleted))
+        return len(deleted)
+
+    def watchChanges(self):
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": {"$in": ["insert", "update", "replace", "delete"]}
+                }
+            }
+        ]
+        with self.embeddings_collection.watch(
+            pipeline, full_document="updateLookup", max_await_time_ms=1000
+        ) as stream:
+            # the stream is open, so a catch-up poll cannot leave a gap
+            self.pollOnce()
+            print("catalog sync is following the change stream")
+
+            # a bulk delete is a burst of events, one reconcile after the burst covers all of them
+            deletes_pending = False
+            while not self.stop_event.is_set():
+                change = stream.try_next()
+                if change is None:
+                    if deletes_pending:
+                        self.reconcileDeletes()
+                        deletes_pending = False
+                    continue
+
+                if change["operationType"] == "delete":
+                    deletes_pending = True
+                elif change.get("fullDocument"):
+                    self.applyDocs([change["fullDocument"]])
+
+    def pollChanges(self):
+        print("catalog sync is polling every ", self.interval, " seconds")
+        polls = 0
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.pollOnce()
+                polls += 1
+                if polls % self.reconcile_every == 0:
+                    self.reconcileDeletes()
+            except PyMongoError as e:
+                self.stats["errors"] += 1
+                print("catalog sync poll failed: ", e)
+
+    def run(self):
+        if self.mode == "changestream":
+            try:
+                self.watchChanges()
+                return
+            except PyMongoError as e:
+                self.stats["errors"] += 1
+                print("change stream not available, polling instead: ", e)
+        self.pollChanges()
+
+    def start(self):
+        if self.mode == "off" or self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name="catalog-sync", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
@@ -0,0 +1,93 @@
+"""Here, I keep a running sum and count of the embeddings of every artist and every tag"""
+
+import numpy as np
+
+from database.normalize import normalizeName
+
+
+class CentroidTable:
+    """
+    Per-artist and per-tag centroids.
+
+    - sums[kind][key] is the sum of the embeddings of the songs with that artist/tag,
+      counts[kind][key] is how many songs were added.
+    - The centroid of several keys is sum(sums) / sum(counts), so a user preference
+      vector is a combination of a handful of centroids instead of a mean over every
+      matching song.
+    - Sums are kept in float64 so that repeated add/remove does not drift.
+    """
+
+    KINDS = ("artist", "tag")
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.sums = {kind: dict() for kind in self.KINDS}
+        self.counts = {kind: dict() for kind in self.KINDS}
+        # song_id -> {"artist": [...], "tag": [...]}, needed to undo a song's contribution
+        self.song_keys = dict()
+
+    @classmethod
+    def build(cls, catalog, track_docs):
+        table = cls(catalog.dim)
+        for doc in track_docs:
+            row = catalog.id_to_row.get(doc["song_id"])
+            if row is not None:
+                table.addSong(
+                    doc["song_id"], catalog.vectors([row])[0], doc["artists"], doc["tags"]
+                )
+
+        print(
+            "centroids built for artists and tags: ",
+            len(table.sums["artist"]),
+            len(table.sums["tag"]),
+        )
+        return table
+
+    def addSong(self, song_id, vector, artists, tags):
+        keys = {"artist": list(artists), "tag": list(tags)}
+        vector = np.asarray(vector, dtype=np.float64)
+
+        for kind, kind_keys in keys.items():
+            for key in kind_keys:
+                if key in self.sums[kind]:
+                    self.sums[kind][key] += vector
+                    self.counts[kind][key] += 1
+                else:
+                    self.sums[kind][key] = vector.copy()
+                    self.counts[kind][key] = 1
+
+        self.song_keys[song_id] = keys
+
+    def removeSong(self, song_id, vector):
+        keys = self.song_keys.pop(song_id, None)
+        if keys is None:
+            return
+
+        vector = np.asarray(vector, dtype=np.float64)
+        for kind, kind_keys in keys.items():
+            for key in kind_keys:
+                self.counts[kind][key] -= 1
+                if self.counts[kind][key] <= 0:
+                    del self.sums[kind][key]
+                    del self.counts[kind][key]
+                else:
+                    self.sums[kind][key] -= vector
+
+    def updateSong(self, song_id, old_vector, new_vector, artists, tags):
+        """Called when a song's embedding changes: old_vector is None for a new song"""
+        if old_vector is not None:
+            self.removeSong(song_id, old_vector)
+        self.addSong(song_id, new_vector, artists, tags)
+
+    def centroidOf(self, kind, keys):
+        """Mean embedding of all the songs that carry any of keys (a song is counted once per key)"""
+        total = np.zeros((self.dim,), dtype=np.float64)
+        count = 0
+        for key in {normalizeName(key) for key in keys}:
+            if key in self.sums[kind]:
+                total += self.sums[kind][key]
+                count += self.counts[kind][key]
+
+        if count == 0:
+            return np.zeros((self.dim,), dtype=np.float32)
+        return (total / count).astype(np.float32)
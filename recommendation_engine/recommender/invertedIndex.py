@@ -0,0 +1,92 @@
+"""Here, I keep artist -> songs and tag -> songs posting lists so that candidate generation never has to query the tracks collection"""
+
+import numpy as np
+
+from database.normalize import normalizeName
+
+
+class InvertedIndex:
+    """
+    Posting lists over catalog rows.
+
+    - postings["artist"][name] and postings["tag"][tag] are sets of catalog rows,
+      keys are normalized (lowercased, trimmed).
+    - song_keys remembers the row and keys each song was indexed under, so that it
+      can be removed again when the track or its row changes.
+    - A track without an embedding has no row yet; it waits in pending until
+      attachRow() is called for it.
+    """
+
+    KINDS = ("artist", "tag")
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.postings = {kind: dict() for kind in self.KINDS}
+        self.song_keys = dict()
+        self.pending = dict()
+
+    @classmethod
+    def build(cls, catalog, track_docs):
+        index = cls(catalog)
+        for doc in track_docs:
+            index.addTrack(doc)
+
+        print(
+            "inverted index built for artists and tags: ",
+            len(index.postings["artist"]),
+            len(index.postings["tag"]),
+        )
+        return index
+
+    def removeTrack(self, song_id):
+        indexed = self.song_keys.pop(song_id, None)
+        if indexed is None:
+            return
+
+        row, keys = indexed
+        for kind, kind_keys in keys.items():
+            for key in kind_keys:
+                rows = self.postings[kind].get(key)
+                if rows is not None:
+                    rows.discard(row)
+                    if not rows:
+                        del self.postings[kind][key]
+
+    def addTrack(self, doc):
+        """doc is a normalized track doc: {"song_id", "artists", "tags"}"""
+        song_id = doc["song_id"]
+        row = self.catalog.id_to_row.get(song_id)
+        if row is None:
+            self.pending[song_id] = doc
+            return
+
+        # indexed with its row now, an older doc must not be attached again later
+        self.pending.pop(song_id, None)
+        self.removeTrack(song_id)
+        keys = {"artist": list(doc["artists"]), "tag": list(doc["tags"])}
+        for kind, kind_keys in keys.items():
+            for key in kind_keys:
+                self.postings[kind].setdefault(key, set()).add(row)
+        self.song_keys[song_id] = (row, keys)
+
+    def attachRow(self, song_id):
+        """Called once song_id has a (new) catalog row, indexes it if it was waiting for one or had another row"""
+        doc = self.pending.pop(song_id, None)
+        if doc is None and song_id in self.song_keys:
+            row, keys = self.song_keys[song_id]
+            if row != self.catalog.id_to_row.get(song_id):
+                # moved out of a read-only shared row, index the same keys under the new row
+                doc = {
+                    "song_id": song_id,
+                    "artists": keys["artist"],
+                    "tags": keys["tag"],
+                }
+        if doc is not None:
+            self.addTrack(doc)
+
+    def rowsFor(self, kind, keys):
+        """Union of the posting lists of keys, as an array of catalog rows"""
+        rows = set()
+        for key in {normalizeName(key) for key in keys}:
+            rows.update(self.postings[kind].get(key, ()))
+        return np.fromiter(rows, dtype=np.int64, count=len(rows))
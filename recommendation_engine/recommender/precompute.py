@@ -0,0 +1,335 @@
+"""Here, I periodically compute the top songs of recently active users in the background, so that their requests are served from a stored list instead of the whole pipeline"""
+
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pandas as pd
+from bson.binary import Binary
+from pymongo import ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from recommender.batchRecommender import BatchRecommender
+from recommender.recommendSongsForUser import hydrateRecords, loadTrackDetails
+
+
+def serializeRecords(records):
+    # same bytes as the live endpoint's ORJSONResponse
+    return orjson.dumps(
+        {"top_songs": records},
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+    )
+
+
+class MemoryRecommendationStore:
+    """Precomputed results of this worker only, used with the sample data"""
+
+    def __init__(self):
+        # user_id -> (computed_at, fingerprint, catalog_version, body)
+        self.entries = dict()
+
+    async def get(self, user_id):
+        return self.entries.get(user_id)
+
+    def acquireRun(self, interval):
+        return True
+
+    def putMany(self, items, computed_at, catalog_version):
+        for user_id, fingerprint, body in items:
+            self.entries[user_id] = (computed_at, fingerprint, catalog_version, body)
+
+    async def delete(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def deleteOlderThan(self, cutoff):
+        for user_id in [u for u, entry in self.entries.items() if entry[0] < cutoff]:
+            del self.entries[user_id]
+
+
+class MongoRecommendationStore:
+    """
+    Precomputed results in the user_recommendations collection, one document per
+    user with _id = user_id, so a read is a single _id lookup.
+
+    Writes happen on the scheduler thread with the sync driver, reads on the
+    request path with the async driver.
+    """
+
+    # the scheduler's lease document, next to the users' documents
+    RUN_ID = "__precompute_run__"
+
+    def __init__(self, collection, async_collection):
+        self.collection = collection
+        self.async_collection = async_collection
+
+    async def get(self, user_id):
+        doc = await self.async_collection.find_one({"_id": user_id})
+        if doc is None:
+            return None
+        return (
+            doc["computed_at"].replace(tzinfo=timezone.utc),
+            doc.get("fingerprint"),
+            doc.get("catalog_version"),
+            bytes(doc["body"]),
+        )
+
+    def acquireRun(self, interval):
+        """Only one worker runs the scheduler per interval: the first to move next_run_at"""
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection.find_one_and_update(
+                {"_id": self.RUN_ID, "next_run_at": {"$lte": now}},
+                {"$set": {"next_run_at": now + timedelta(seconds=interval)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            # the document exists and its next_run_at is in the future
+            return False
+
+    def putMany(self, items, computed_at, catalog_version):
+        requests = [
+            ReplaceOne(
+                {"_id": user_id},
+                {
+                    "_id": user_id,
+                    "body": Binary(body),
+                    "fingerprint": fingerprint,
+                    "catalog_version": catalog_version,
+                    "computed_at": computed_at,
+                },
+                upsert=True,
+            )
+            for user_id, fingerprint, body in items
+        ]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    async def delete(self, user_id):
+        await self.async_collection.delete_one({"_id": user_id})
+
+    def deleteOlderThan(self, cutoff):
+        self.collection.delete_many({"computed_at": {"$lt": cutoff}})
+
+
+class RecommendationPrecomputer:
+    """
+    Recomputes the top songs of the users who interacted with songs in the last
+    active_window seconds, every interval seconds.
+
+    - Users come from usersonginteractions.updatedAt (most recent first, at most
+      max_users per run) and are scored batch_size at a time with BatchRecommender.
+    - A stored list is served while it is younger than max_age seconds and was
+      computed from the user's current profile and the current catalog version,
+      like the result cache. Anything else falls back to live computation, and lists
+      older than max_age are removed at the end of every run.
+    - With several workers, the store's lease lets only one of them run per interval.
+    - Users without any candidate song are skipped, the live path answers them.
+    - Everything is read from state (app.state) because a catalog reload replaces it.
+    """
+
+    def __init__(
+        self,
+        state,
+        store,
+        interval=300.0,
+        active_window=86400.0,
+        max_age=900.0,
+        max_users=10000,
+        batch_size=256,
+        top_k=40,
+    ):
+        self.state = state
+        self.store = store
+        self.interval = interval
+        self.active_window = active_window
+        self.max_age = max_age
+        self.max_users = max_users
+        self.batch_size = batch_size
+        self.top_k = top_k
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {
+            "runs": 0,
+            "users_computed": 0,
+            "last_run_seconds": None,
+            "served": 0,
+            "stale": 0,
+            "changed": 0,
+            "missing": 0,
+            "errors": 0,
+        }
+
+    def activeUsers(self, since):
+        """user_ids with an interaction updated at or after since, most recent first"""
+        interactions = self.state.user_song_interaction_collection
+        if self.state.use_sample_data == True:
+            updated_at = pd.to_datetime(interactions["updatedAt"], utc=True)
+            recent = interactions[updated_at >= since].assign(
+                updated_at=updated_at[updated_at >= since]
+            )
+            last_seen = recent.groupby("user_id")["updated_at"].max()
+            return (
+                last_seen.sort_values(ascending=False).index[: self.max_users].tolist()
+            )
+
+        pipeline = [
+            {"$match": {"updatedAt": {"$gte": since}}},
+            {"$group": {"_id": "$user_id", "last_seen": {"$max": "$updatedAt"}}},
+            {"$sort": {"last_seen": -1}},
+            {"$limit": self.max_users},
+        ]
+        return [doc["_id"] for doc in interactions.aggregate(pipeline)]
+
+    def hasCandidates(self, profile):
+        """Same check as the live path, which fails for users whose preferences match no song"""
+        if profile.isEmpty():
+            return False
+        state = self.state
+        return (
+            len(state.inverted_index.rowsFor("artist", profile.fav_artists))
+            + len(state.inverted_index.rowsFor("tag", profile.fav_genres))
+            + len(state.catalog.rowsFor(profile.liked_songs))
+        ) > 0
+
+    def computeUsers(self, user_ids):
+        """Scores and hydrates one batch of users, returns (user_id, fingerprint, body) triples"""
+        state = self.state
+        profiles = {
+            user_id: profile
+            for user_id, profile in state.profile_loader.loadMany(user_ids).items()
+            if self.hasCandidates(profile)
+        }
+        if not profiles:
+            return list()
+
+        recommendations = BatchRecommender(
+            list(profiles),
+            state.catalog,
+            state.centroids,
+            state.inverted_index,
+            state.profile_loader,
+            top_k=self.top_k,
+        ).scoreProfiles(profiles)
+
+        song_ids = list(
+            dict.fromkeys(
+                str(record["song_id"])
+                for records in recommendations.values()
+                for record in records
+            )
+        )
+        details = state.track_details_cache.getMany(
+            song_ids,
+            lambda missing: loadTrackDetails(
+                state.tracks_collection, state.use_sample_data, missing
+            ),
+        )
+
+        items = list()
+        for user_id, records in recommendations.items():
+            for record in records:
+                record["song_id"] = str(record["song_id"])
+            items.append(
+                (
+                    user_id,
+                    profiles[user_id].fingerprint(),
+                    serializeRecords(hydrateRecords(records, details)),
+                )
+            )
+        return items
+
+    def runOnce(self):
+        if not self.store.acquireRun(self.interval):
+            # another worker has this interval
+            return 0
+
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        user_ids = self.activeUsers(now - timedelta(seconds=self.active_window))
+
+        computed = 0
+        for start in range(0, len(user_ids), self.batch_size):
+            if self.stop_event.is_set():
+                break
+            # stamped before scoring, so neither the age nor the catalog version is newer than the list
+            computed_at = datetime.now(timezone.utc)
+            catalog_version = self.state.catalog.catalogVersion()
+            items = self.computeUsers(user_ids[start : start + self.batch_size])
+            self.store.putMany(items, computed_at, catalog_version)
+            computed += len(items)
+
+        self.store.deleteOlderThan(now - timedelta(seconds=self.max_age))
+
+        self.stats["runs"] += 1
+        self.stats["users_computed"] += computed
+        self.stats["last_run_seconds"] = time.perf_counter() - started
+        print(
+            "precomputed recommendations for active users: ",
+            computed,
+            " in ",
+            self.stats["last_run_seconds"],
+        )
+        return computed
+
+    async def getFresh(self, user_id, profile, catalog_version):
+        """
+        The stored body of user_id if it is younger than max_age and was computed from
+        this profile and catalog version, otherwise None
+        """
+        try:
+            stored = await self.store.get(user_id)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print("precomputed recommendations read failed: ", e)
+            return None
+
+        if stored is None:
+            self.stats["missing"] += 1
+            return None
+
+        computed_at, fingerprint, stored_version, body = stored
+        age = (datetime.now(timezone.utc) - computed_at).total_seconds()
+        if age > self.max_age:
+            self.stats["stale"] += 1
+            return None
+        if fingerprint != profile.fingerprint() or stored_version != catalog_version:
+            # the user's preferences or the catalog moved since the list was computed
+            self.stats["changed"] += 1
+            return None
+
+        self.stats["served"] += 1
+        return body
+
+    async def invalidateUser(self, user_id):
+        await self.store.delete(user_id)
+
+    def run(self):
+        # the first run starts right away, so active users are covered soon after startup
+        while not self.stop_event.is_set():
+            try:
+                self.runOnce()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print("precomputing recommendations failed: ", e)
+            if self.stop_event.wait(self.interval):
+                break
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name="recommendation-precompute", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def report(self):
+        return dict(self.stats)
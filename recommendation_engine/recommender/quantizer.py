@@ -0,0 +1,150 @@
+"""Here, I keep a compact (float16 or int8) copy of the catalog matrix for the first pass scan, the float32 rows are only used to rescore a short list"""
+
+import numpy as np
+
+from recommender.ranking import topKRows
+
+
+class QuantizedMatrix:
+    """
+    Row-major quantized copy of the embeddings matrix.
+
+    - "float16" stores every value as a half float (half the memory of float32).
+    - "int8" stores every value as one byte, with a per-dimension offset and scale:
+      x ~= (code + 128) * scale + offset (a quarter of the memory of float32).
+    - dot() decodes block by block, so the full float32 matrix is never rebuilt.
+    - Rows are kept in a buffer with spare capacity, so that appending a song does
+      not copy the whole matrix every time.
+    """
+
+    MODES = ("float16", "int8")
+
+    def __init__(self, mode, dim, scale=None, offset=None):
+        if mode not in self.MODES:
+            raise ValueError("unknown quantization mode: " + str(mode))
+
+        self.mode = mode
+        self.dim = dim
+        self.scale = scale
+        self.offset = offset
+        self.dtype = np.float16 if mode == "float16" else np.int8
+        self.buffer = np.zeros((0, dim), dtype=self.dtype)
+        self.size = 0
+
+    @classmethod
+    def fromMatrix(cls, matrix, mode, block_size=65536):
+        scale = offset = None
+        if mode == "int8" and matrix.shape[0] > 0:
+            offset = matrix.min(axis=0).astype(np.float32)
+            scale = ((matrix.max(axis=0) - offset) / 255).astype(np.float32)
+            # a constant dimension still needs a non zero scale
+            scale[scale == 0] = 1.0
+
+        quantized = cls(mode, matrix.shape[1], scale, offset)
+        quantized.buffer = np.empty((matrix.shape[0], matrix.shape[1]), quantized.dtype)
+        for start in range(0, matrix.shape[0], block_size):
+            quantized.buffer[start : start + block_size] = quantized.encode(
+                matrix[start : start + block_size]
+            )
+        quantized.size = matrix.shape[0]
+
+        print(
+            "catalog quantized to ",
+            mode,
+            ", bytes: ",
+            quantized.buffer.nbytes,
+            " instead of ",
+            matrix.shape[0] * matrix.shape[1] * 4,
+        )
+        return quantized
+
+    @property
+    def codes(self):
+        return self.buffer[: self.size]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def encode(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.mode == "float16":
+            return vectors.astype(np.float16)
+
+        if self.scale is None:
+            # built from an empty catalog, the first rows fix the range
+            self.offset = vectors.min(axis=0)
+            self.scale = (vectors.max(axis=0) - self.offset) / 255
+            self.scale[self.scale == 0] = 1.0
+
+        # values outside the range seen at build time are clipped, rescoring fixes their scores
+        codes = np.rint((vectors - self.offset) / self.scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes):
+        codes = codes.astype(np.float32)
+        if self.mode == "float16":
+            return codes
+        return (codes + 128) * self.scale + self.offset
+
+    def upsert(self, row, vector):
+        code = self.encode(np.asarray(vector)[None, :])[0]
+        if row < self.size:
+            self.buffer[row] = code
+            return
+
+        if row >= self.buffer.shape[0]:
+            grown = np.zeros(
+                (max(row + 1, int(self.buffer.shape[0] * 1.5) + 16), self.dim),
+                dtype=self.dtype,
+            )
+            grown[: self.size] = self.codes
+            self.buffer = grown
+        self.buffer[row] = code
+        self.size = row + 1
+
+    def dot(self, query, rows=None, block_size=16384):
+        """Approximate embeddings @ query for every row (or only the given rows)"""
+        query = np.asarray(query, dtype=np.float32)
+        codes = self.codes if rows is None else self.codes[rows]
+
+        if self.mode == "float16":
+            query_codes = query
+            constant = np.float32(0)
+        else:
+            # (code + 128) * scale + offset, dotted with query, split into a product and a constant
+            query_codes = self.scale * query
+            constant = np.dot(128 * self.scale + self.offset, query)
+
+        scores = np.empty((codes.shape[0],), dtype=np.float32)
+        for start in range(0, codes.shape[0], block_size):
+            block = codes[start : start + block_size].astype(np.float32)
+            scores[start : start + block_size] = block @ query_codes
+        return scores + constant
+
+
+def recallCheck(catalog, rescore_candidates, k=40, n_queries=20, seed=42):
+    """
+    Mean recall@k of the quantized scan followed by float32 rescoring of
+    rescore_candidates rows, against exact search over the full matrix.
+
+    Queries are means of a few random songs, which look like user preference vectors.
+    """
+    if catalog.quantized is None or catalog.size == 0 or n_queries <= 0:
+        return None
+
+    rng = np.random.default_rng(seed)
+    k = min(k, catalog.size)
+    recalls = list()
+    for _ in range(n_queries):
+        rows = rng.choice(catalog.size, size=min(5, catalog.size), replace=False)
+        query = catalog.vectors(rows).mean(axis=0)
+
+        exact = topKRows(catalog.cosineScores(query), k)
+        shortlist = catalog.shortlist(query, rescore_candidates)
+        rescored = shortlist[topKRows(catalog.cosineScores(query, shortlist), k)]
+        recalls.append(len(np.intersect1d(exact, rescored)) / k)
+
+    recall = float(np.mean(recalls))
+    print("quantized search recall@", k, ": ", recall)
+    return recall
@@ -0,0 +1,88 @@
+"""Array based ranking: bonus scores from candidate bit flags and partial top-k selection"""
+
+import numpy as np
+
+# one bit per candidate type, a song can carry several of them
+FAV_GENRES = 1
+FAV_ARTISTS = 2
+LIKED_SONGS = 4
+
+BONUS_PER_MATCH = 0.05
+
+# bonus for every possible combination of the 3 flags: 0.05 per matching type
+BONUS_BY_FLAGS = np.array(
+    [BONUS_PER_MATCH * bin(flags).count("1") for flags in range(8)], dtype=np.float32
+)
+
+
+def safeMean(vectors, dim):
+    if len(vectors) == 0:
+        return np.zeros((dim,), dtype=np.float32)
+    return np.nan_to_num(np.mean(vectors, axis=0), nan=0.0)
+
+
+def preferenceVector(catalog, centroids, fav_artists, fav_genres, liked_songs_rows):
+    """
+    User preference vector: 0.5 liked songs + 0.3 fav artists + 0.2 fav genres.
+
+    The artist and genre parts come from the precomputed centroid table, only the
+    (few) liked songs are gathered from the catalog.
+    """
+    artist_pref_vec = centroids.centroidOf("artist", fav_artists)
+    genre_pref_vec = centroids.centroidOf("tag", fav_genres)
+    liked_pref_vec = safeMean(catalog.vectors(liked_songs_rows), catalog.dim)
+
+    user_pref_embedding = (
+        0.5 * liked_pref_vec + 0.3 * artist_pref_vec + 0.2 * genre_pref_vec
+    )
+    return np.nan_to_num(user_pref_embedding, nan=0.0).astype(np.float32)
+
+
+def candidateFlags(n_rows, rows_by_flag):
+    """
+    Builds the flags for n_rows songs.
+
+    rows_by_flag maps a flag (FAV_GENRES, FAV_ARTISTS, LIKED_SONGS) to the positions
+    of the songs that matched it.
+    """
+    flags = np.zeros((n_rows,), dtype=np.uint8)
+    for flag, rows in rows_by_flag.items():
+        flags[rows] |= flag
+    return flags
+
+
+def bonusScores(flags):
+    return BONUS_BY_FLAGS[flags]
+
+
+def topKRows(scores, k):
+    """Positions of the k highest scores, best first, without sorting the whole array"""
+    if len(scores) <= k:
+        return np.argsort(-scores, kind="stable")
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def rankedRecords(song_ids, sim_scores, bonus_scores, k=40):
+    """Response records for the top k songs only, built straight from the score arrays"""
+    final_scores = sim_scores + bonus_scores
+    top = topKRows(final_scores, k)
+    # deleted songs score -inf, they only get here when fewer than k songs are left
+    top = top[np.isfinite(final_scores[top])]
+
+    # tolist() gives plain python values, the json encoder needs no numpy fallback
+    return [
+        {
+            "song_id": song_id,
+            "sim_score": sim_score,
+            "bonus_score": bonus_score,
+            "final_score": final_score,
+        }
+        for song_id, sim_score, bonus_score, final_score in zip(
+            song_ids[top].tolist(),
+            sim_scores[top].tolist(),
+            bonus_scores[top].tolist(),
+            final_scores[top].tolist(),
+        )
+    ]
@@ -0,0 +1,187 @@
+"""Here, I cache the serialized recommendations of a user, so that opening the app again with the same preferences does not run the whole pipeline"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class InProcessResultStore:
+    """
+    Bounded LRU of serialized results in this worker, with an index per user for
+    invalidation. An entry expires ttl seconds after it was written, like a user's
+    hash in RedisResultStore.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (user_id, key) -> (expires_at, bytes), least recently used first
+        self.entries = OrderedDict()
+        # user_id -> set of keys of that user
+        self.user_keys = dict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    async def get(self, user_id, key):
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[(user_id, key)]
+                self.forgetKey(user_id, key)
+                return None
+            self.entries.move_to_end((user_id, key))
+            return value
+
+    async def set(self, user_id, key, value):
+        with self.lock:
+            self.entries[(user_id, key)] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end((user_id, key))
+            self.user_keys.setdefault(user_id, set()).add(key)
+
+            while len(self.entries) > self.max_entries:
+                (old_user_id, old_key), _ = self.entries.popitem(last=False)
+                self.forgetKey(old_user_id, old_key)
+                self.evictions += 1
+
+    def forgetKey(self, user_id, key):
+        keys = self.user_keys.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[user_id]
+
+    async def deleteUser(self, user_id):
+        with self.lock:
+            for key in self.user_keys.pop(user_id, ()):
+                self.entries.pop((user_id, key), None)
+
+    async def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_keys.clear()
+
+    def size(self):
+        return len(self.entries)
+
+
+class RedisResultStore:
+    """
+    Results in Redis (or anything that speaks its protocol), shared by every worker.
+
+    - Every user has one hash, field = key, so a user is invalidated with one DEL.
+    - A hash expires ttl seconds after its last write, and only the newest
+      max_per_user results are kept in it. The total size is bounded by the
+      server's maxmemory policy (allkeys-lru).
+    """
+
+    PREFIX = "echofinder:recs:"
+
+    def __init__(self, url, ttl=3600, max_per_user=4):
+        # only needed for this backend
+        from redis import asyncio as aioredis
+
+        self.client = aioredis.from_url(url)
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+
+    async def get(self, user_id, key):
+        return await self.client.hget(self.PREFIX + user_id, key)
+
+    async def set(self, user_id, key, value):
+        name = self.PREFIX + user_id
+        if await self.client.hlen(name) >= self.max_per_user:
+            # older profiles or catalog versions of this user, they cannot be hit again
+            await self.client.delete(name)
+
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(name, key, value)
+            pipe.expire(name, self.ttl)
+            await pipe.execute()
+
+    async def deleteUser(self, user_id):
+        await self.client.delete(self.PREFIX + user_id)
+
+    async def clear(self):
+        async for name in self.client.scan_iter(match=self.PREFIX + "*"):
+            await self.client.delete(name)
+
+    def size(self):
+        return None
+
+
+class ResultCache:
+    """
+    Serialized recommendations keyed by (user_id, profile fingerprint, catalog version).
+
+    - The profile fingerprint changes when the user's favourite artists, genres or
+      liked songs change, so such a write is never answered from the cache.
+    - The catalog version changes with every catalog update, so results computed
+      on an older catalog are never returned.
+    - invalidateUser() drops every entry of a user (called by the backend after it
+      writes the user's collections), clear() drops everything.
+    - A failing backend is treated as a miss, the request is computed as usual.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    @staticmethod
+    def key(profile, catalog_version):
+        return profile.fingerprint() + ":" + str(catalog_version)
+
+    async def get(self, profile, catalog_version):
+        try:
+            value = await self.store.get(
+                profile.user_id, self.key(profile, catalog_version)
+            )
+        except Exception as e:
+            self.stats["errors"] += 1
+            print("result cache read failed: ", e)
+            value = None
+
+        self.stats["hits" if value is not None else "misses"] += 1
+        return value
+
+    async def set(self, profile, catalog_version, value):
+        try:
+            await self.store.set(
+                profile.user_id, self.key(profile, catalog_version), value
+            )
+            self.stats["stores"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print("result cache write failed: ", e)
+
+    async def invalidateUser(self, user_id):
+        await self.store.deleteUser(user_id)
+
+    async def clear(self):
+        await self.store.clear()
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(
+            self.stats,
+            size=self.store.size(),
+            hit_rate=self.stats["hits"] / lookups if lookups else None,
+        )
+
+
+def buildResultCache(settings):
+    """The result cache configured by RESULT_CACHE_BACKEND, or None when it is off"""
+    if settings.RESULT_CACHE_BACKEND == "off":
+        return None
+    if settings.RESULT_CACHE_BACKEND == "memory":
+        return ResultCache(
+            InProcessResultStore(settings.RESULT_CACHE_SIZE, settings.RESULT_CACHE_TTL)
+        )
+    if settings.RESULT_CACHE_BACKEND == "redis":
+        return ResultCache(
+            RedisResultStore(settings.RESULT_CACHE_REDIS_URL, settings.RESULT_CACHE_TTL)
+        )
+    raise ValueError("unknown result cache backend: " + settings.RESULT_CACHE_BACKEND)
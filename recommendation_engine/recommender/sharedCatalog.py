@@ -0,0 +1,313 @@
+"""Here, I publish the catalog in multiprocessing.shared_memory segments owned by a supervisor process, so that every uvicorn worker attaches to the same pages instead of loading its own copy"""
+
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from recommender.catalogStore import CatalogStore
+
+SHARED_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+SEGMENT_PREFIX = "echofinder_"
+
+# segments attached by this process: version -> list of SharedMemory, see releaseVersions()
+attached = dict()
+
+
+def featureColumns(song_ids, track_docs, kind):
+    """
+    Artist or tag keys of every catalog row as three arrays: the unique keys, and
+    per row offsets into a codes array, so row i has keys[codes[offsets[i]:offsets[i + 1]]].
+    """
+    keys_of = {doc["song_id"]: doc[kind] for doc in track_docs}
+    code_of = dict()
+    codes = list()
+    offsets = np.zeros((len(song_ids) + 1,), dtype=np.int64)
+    for row, song_id in enumerate(song_ids):
+        for key in keys_of.get(song_id, ()):
+            codes.append(code_of.setdefault(key, len(code_of)))
+        offsets[row + 1] = len(codes)
+
+    keys = np.array(list(code_of), dtype=str) if code_of else np.zeros((0,), "<U1")
+    return keys, offsets, np.array(codes, dtype=np.int32)
+
+
+def trackDocsFromColumns(song_ids, columns):
+    """Normalized track docs rebuilt from the artist and tag columns, one per catalog row"""
+    artist_keys, artist_offsets, artist_codes = columns["artists"]
+    tag_keys, tag_offsets, tag_codes = columns["tags"]
+    for row, song_id in enumerate(song_ids):
+        yield {
+            "song_id": str(song_id),
+            "artists": artist_keys[
+                artist_codes[artist_offsets[row] : artist_offsets[row + 1]]
+            ].tolist(),
+            "tags": tag_keys[
+                tag_codes[tag_offsets[row] : tag_offsets[row + 1]]
+            ].tolist(),
+        }
+
+
+def segmentArray(segment, spec):
+    # np.frombuffer holds the buffer until the array is gone, so segment.close()
+    # raises BufferError instead of unmapping memory that is still read
+    shape = tuple(spec["shape"])
+    return np.frombuffer(
+        segment.buf, dtype=np.dtype(spec["dtype"]), count=int(np.prod(shape))
+    ).reshape(shape)
+
+
+def readManifest(shared_dir):
+    manifest_path = os.path.join(shared_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SHARED_FORMAT:
+        print("shared catalog has an unknown format: ", manifest.get("format"))
+        return None
+    return manifest
+
+
+class SharedCatalogPublisher:
+    """
+    Supervisor side: owns the segments of every published version.
+
+    - Every part (embeddings, norms, song ids, artist and tag columns) is one segment
+      whose name carries the version, so a rebuild never touches segments in use.
+    - The manifest is replaced atomically once all segments of a version are
+      written, workers see either the old or the new version, never a mix.
+    - Only the newest keep versions are kept. An unlinked segment stays valid for
+      the workers that still map it, it is freed when the last one lets go.
+    """
+
+    def __init__(self, shared_dir, keep=2):
+        self.shared_dir = shared_dir
+        self.keep = keep
+        # version -> list of SharedMemory, oldest first
+        self.versions = dict()
+
+    def createSegment(self, version, part, shape, dtype):
+        """Creates one segment and returns its spec for the manifest and an array over it"""
+        dtype = np.dtype(dtype)
+        segment = shared_memory.SharedMemory(
+            name=SEGMENT_PREFIX + version + "_" + part,
+            create=True,
+            # a segment cannot be empty
+            size=max(int(np.prod(shape)) * dtype.itemsize, 1),
+        )
+        self.versions[version].append(segment)
+        spec = {"name": segment.name, "dtype": dtype.str, "shape": list(shape)}
+        return spec, segmentArray(segment, spec)
+
+    def publishArray(self, version, part, array):
+        array = np.ascontiguousarray(array)
+        spec, target = self.createSegment(version, part, array.shape, array.dtype)
+        target[...] = array
+        return spec
+
+    def publish(self, catalog, track_docs, updated_at=None, block_size=65536):
+        """Writes a new version from a CatalogStore and its normalized track docs, returns the manifest"""
+        os.makedirs(self.shared_dir, exist_ok=True)
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        self.versions[version] = list()
+
+        rows = np.setdiff1d(np.arange(catalog.size), catalog.dead_rows)
+        song_ids = [str(song_id) for song_id in catalog.songIdsOf(rows)]
+        track_docs = list(track_docs)
+
+        # the embeddings are copied block by block, never as one more full matrix
+        segments = dict()
+        segments["embeddings"], target = self.createSegment(
+            version, "embeddings", (len(rows), catalog.dim), np.float32
+        )
+        for start in range(0, len(rows), block_size):
+            target[start : start + block_size] = catalog.vectors(
+                rows[start : start + block_size]
+            )
+        del target
+
+        segments["norms"] = self.publishArray(
+            version, "norms", catalog.normsOf(rows).astype(np.float32)
+        )
+        segments["song_ids"] = self.publishArray(
+            version, "song_ids", np.array(song_ids, dtype=str)
+        )
+        for kind in ("artists", "tags"):
+            keys, offsets, codes = featureColumns(song_ids, track_docs, kind)
+            for part, array in zip(
+                ("keys", "offsets", "codes"), (keys, offsets, codes)
+            ):
+                segments[kind + "_" + part] = self.publishArray(
+                    version, kind + "_" + part, array
+                )
+
+        manifest = {
+            "format": SHARED_FORMAT,
+            "version": version,
+            "rows": len(song_ids),
+            "dim": catalog.dim,
+            "updated_at": updated_at or catalog.updated_at,
+            "segments": segments,
+        }
+        manifest_path = os.path.join(self.shared_dir, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+        self.unlinkOldVersions()
+        print("shared catalog published: ", version, ", rows: ", manifest["rows"])
+        return manifest
+
+    def unlinkVersion(self, version):
+        for segment in self.versions.pop(version, ()):
+            segment.close()
+            segment.unlink()
+
+    def unlinkOldVersions(self):
+        for version in sorted(self.versions)[: -self.keep]:
+            self.unlinkVersion(version)
+
+    def close(self):
+        manifest_path = os.path.join(self.shared_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        for version in list(self.versions):
+            self.unlinkVersion(version)
+        print("shared catalog segments removed")
+
+
+def openSegment(name):
+    """
+    Opens a segment the supervisor owns. It must not be tracked here: the resource
+    tracker of this worker would unlink it when the worker exits.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    segment = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # tracked under the POSIX name, which is the public name with a leading slash
+        resource_tracker.unregister("/" + segment.name, "shared_memory")
+    return segment
+
+
+def attachSegment(spec):
+    segment = openSegment(spec["name"])
+
+    array = segmentArray(segment, spec)
+    array.flags.writeable = False
+    return segment, array
+
+
+def attachSharedCatalog(shared_dir):
+    """
+    Worker side: attaches the version in the manifest read-only.
+
+    Returns (catalog, track_docs) or None when nothing is published or the version
+    was already unlinked. Rows that change later are tombstoned and appended to
+    the catalog tail, the shared rows are never written.
+
+    Only the embeddings, norms, song ids and artist/tag columns are shared. The
+    worker still builds its own id_to_row, and the centroids, inverted index, ANN
+    index and quantized copy made from the catalog.
+    """
+    manifest = readManifest(shared_dir)
+    if manifest is None:
+        return None
+
+    segments = list()
+    arrays = dict()
+    try:
+        for part, spec in manifest["segments"].items():
+            segment, arrays[part] = attachSegment(spec)
+            segments.append(segment)
+    except FileNotFoundError as e:
+        print("shared catalog ", manifest["version"], " is gone: ", e)
+        for segment in segments:
+            segment.close()
+        return None
+    attached[manifest["version"]] = segments
+
+    catalog = CatalogStore(
+        arrays["song_ids"], arrays["embeddings"], norms=arrays["norms"], copy=False
+    )
+    catalog.version = manifest["version"]
+    catalog.updated_at = manifest["updated_at"]
+    catalog.shared = True
+
+    columns = {
+        kind: (
+            arrays[kind + "_keys"],
+            arrays[kind + "_offsets"],
+            arrays[kind + "_codes"],
+        )
+        for kind in ("artists", "tags")
+    }
+    print(
+        "catalog attached to shared memory: ", catalog.version, ", rows: ", catalog.size
+    )
+    return catalog, trackDocsFromColumns(arrays["song_ids"], columns)
+
+
+def releaseVersions(keep_version):
+    """
+    Closes the segments of the other versions this worker attached. A version that
+    is still read by a request cannot be closed yet, it is tried again next time.
+    """
+    for version in [version for version in attached if version != keep_version]:
+        try:
+            for segment in attached[version]:
+                segment.close()
+        except BufferError:
+            continue
+        del attached[version]
+
+
+class SharedCatalogWatcher:
+    """Polls the manifest and calls reload() when the supervisor publishes a new version"""
+
+    def __init__(self, shared_dir, current_version, reload, interval=5.0):
+        self.shared_dir = shared_dir
+        self.current_version = current_version
+        self.reload = reload
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def checkOnce(self):
+        manifest = readManifest(self.shared_dir)
+        if manifest is None or manifest["version"] == self.current_version():
+            return False
+
+        print("new shared catalog version: ", manifest["version"])
+        self.reload()
+        releaseVersions(self.current_version())
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.checkOnce()
+            except Exception as e:
+                print("shared catalog reload failed: ", e)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(
+            target=self.run, name="shared-catalog-watcher", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
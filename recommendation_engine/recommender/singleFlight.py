@@ -0,0 +1,47 @@
+"""Here, I let concurrent identical requests share one computation instead of each running the whole pipeline"""
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    - The first call for a key (the leader) starts fn() as a task, calls for the same
+      key that arrive while it runs await that task and get its result or its error.
+    - The task is shielded, so a caller that goes away (client disconnect) does not
+      cancel the work the others are waiting for.
+    - Only the event loop touches in_flight, so no lock is needed.
+    """
+
+    def __init__(self):
+        self.in_flight = dict()
+        self.stats = {"calls": 0, "leaders": 0, "collapsed": 0, "errors": 0}
+
+    async def run(self, key, fn):
+        self.stats["calls"] += 1
+        task = self.in_flight.get(key)
+        if task is None:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(fn())
+            self.in_flight[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done))
+        else:
+            self.stats["collapsed"] += 1
+
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    def report(self):
+        return dict(
+            self.stats,
+            in_flight=len(self.in_flight),
+            collapsed_rate=(
+                self.stats["collapsed"] / self.stats["calls"]
+                if self.stats["calls"]
+                else None
+            ),
+        )
@@ -0,0 +1,94 @@
+"""Here, I keep the track details sent with every recommendation (title, artists, image, spotify ids) so that popular songs are not read from trackdetails on every request"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TrackDetailsCache:
+    """
+    Bounded LRU cache of track details keyed by song_id, with a time to live.
+
+    - getMany() returns the cached songs and fetches only the missing or expired
+      ones, with one query for all of them.
+    - An entry expires ttl seconds after it was fetched, so an edit that no hook
+      sees (another worker, a manual fix) is picked up within ttl.
+    - invalidate() is called when a track or its embedding is written, clear() on a
+      full catalog reload.
+    - Safe to use from the scoring threads and the event loop at the same time.
+    """
+
+    def __init__(self, max_size=20000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        # song_id -> (expires_at, doc), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def lookup(self, song_ids):
+        """Returns (song_id -> doc for the fresh entries, list of the other song ids)"""
+        now = time.monotonic()
+        found = dict()
+        missing = list()
+        with self.lock:
+            for song_id in song_ids:
+                entry = self.entries.get(song_id)
+                if entry is None or entry[0] < now:
+                    missing.append(song_id)
+                    continue
+                self.entries.move_to_end(song_id)
+                found[song_id] = entry[1]
+
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(missing)
+        return found, missing
+
+    def store(self, docs):
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for doc in docs:
+                self.entries[doc["song_id"]] = (expires_at, doc)
+                self.entries.move_to_end(doc["song_id"])
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def getMany(self, song_ids, fetch):
+        """song_id -> doc for song_ids, fetch(missing song ids) returns the docs that are not cached"""
+        found, missing = self.lookup(song_ids)
+        if missing:
+            docs = list(fetch(missing))
+            self.store(docs)
+            found.update((doc["song_id"], doc) for doc in docs)
+        return found
+
+    async def getManyAsync(self, song_ids, fetch):
+        """Same as getMany, with an async fetch"""
+        found, missing = self.lookup(song_ids)
+        if missing:
+            docs = list(await fetch(missing))
+            self.store(docs)
+            found.update((doc["song_id"], doc) for doc in docs)
+        return found
+
+    def invalidate(self, song_ids):
+        with self.lock:
+            for song_id in song_ids:
+                if self.entries.pop(song_id, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.stats["invalidations"] += len(self.entries)
+            self.entries.clear()
+
+    def report(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                size=len(self.entries),
+                hit_rate=self.stats["hits"] / lookups if lookups else None,
+            )
@@ -0,0 +1,52 @@
+"""Reads the few track fields the serving side needs (song_id, artist names, tags)"""
+
+from database.normalize import normalizeName, splitTags
+
+
+TRACK_DOC_PROJECTION = {
+    "_id": False,
+    "song_id": True,
+    "artists.name": True,
+    "all_tags": True,
+    "tags": True,
+}
+
+
+def normalizeTrackDoc(doc):
+    return {
+        "song_id": doc["song_id"],
+        "artists": list(
+            dict.fromkeys(
+                normalizeName(artist.get("name"))
+                for artist in doc.get("artists") or []
+                if isinstance(artist, dict) and artist.get("name")
+            )
+        ),
+        # tracks ingested before the tags array existed only have all_tags
+        "tags": splitTags(
+            doc["tags"] if isinstance(doc.get("tags"), list) else doc.get("all_tags")
+        ),
+    }
+
+
+def loadTrackDocs(tracks_collection, use_sample_data):
+    if use_sample_data == True:
+        columns = [
+            column
+            for column in ("song_id", "artists", "all_tags", "tags")
+            if column in tracks_collection.columns
+        ]
+        docs = tracks_collection[columns].to_dict(orient="records")
+    else:
+        docs = tracks_collection.find({}, projection=TRACK_DOC_PROJECTION)
+
+    for doc in docs:
+        yield normalizeTrackDoc(doc)
+
+
+def loadTrackDocsFor(tracks_collection, song_ids):
+    """song_id -> normalized track doc, for the given songs only"""
+    docs = tracks_collection.find(
+        {"song_id": {"$in": list(song_ids)}}, projection=TRACK_DOC_PROJECTION
+    )
+    return {doc["song_id"]: normalizeTrackDoc(doc) for doc in docs}
@@ -0,0 +1,191 @@
+"""Here, I load what a user likes (genres, artists, songs) with per-user queries that run concurrently"""
+
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class UserProfile:
+    user_id: str
+    fav_artists: List[str] = field(default_factory=list)
+    fav_genres: List[str] = field(default_factory=list)
+    liked_songs: List[str] = field(default_factory=list)
+
+    def isEmpty(self):
+        return not (self.fav_artists or self.fav_genres or self.liked_songs)
+
+    def fingerprint(self):
+        """Hash of what the recommendations depend on, order does not matter for scoring"""
+        digest = hashlib.sha1()
+        for values in (self.fav_artists, self.fav_genres, self.liked_songs):
+            for value in sorted(set(str(value) for value in values)):
+                digest.update(value.encode("utf-8"))
+                digest.update(b"\0")
+            digest.update(b"\1")
+        return digest.hexdigest()
+
+
+def parseFavGenres(fav_genres):
+    """fav_genres is stored either as ["pop,rock"] or as ["pop", "rock"]"""
+    if not isinstance(fav_genres, (list, tuple)):
+        return list()
+    return [
+        genre.strip()
+        for entry in fav_genres
+        if isinstance(entry, str)
+        for genre in entry.split(",")
+        if genre.strip()
+    ]
+
+
+def genresFromDocs(docs):
+    genres = dict()
+    for doc in docs:
+        # only the first document of a user is used
+        if doc["user_id"] not in genres:
+            genres[doc["user_id"]] = parseFavGenres(doc.get("fav_genres"))
+    return genres
+
+
+def artistsFromDocs(docs):
+    artists = dict()
+    for doc in docs:
+        if doc.get("fav_artist"):
+            artists.setdefault(doc["user_id"], list()).append(doc["fav_artist"])
+    return artists
+
+
+def likedSongsFromDocs(docs):
+    liked_songs = dict()
+    for doc in docs:
+        liked_songs.setdefault(doc["user_id"], list()).append(doc["song_id"])
+    return liked_songs
+
+
+def profilesFrom(user_ids, genre_docs, artist_docs, liked_song_docs):
+    genres = genresFromDocs(genre_docs)
+    artists = artistsFromDocs(artist_docs)
+    liked_songs = likedSongsFromDocs(liked_song_docs)
+
+    return {
+        user_id: UserProfile(
+            user_id,
+            fav_artists=artists.get(user_id, list()),
+            fav_genres=genres.get(user_id, list()),
+            liked_songs=liked_songs.get(user_id, list()),
+        )
+        for user_id in user_ids
+    }
+
+
+def userQuery(user_ids, fields):
+    """Filter on user_id (equality for one user, $in for a batch) and a tight projection"""
+    user_filter = user_ids[0] if len(user_ids) == 1 else {"$in": list(user_ids)}
+    return (
+        {"user_id": user_filter},
+        {"_id": False, "user_id": True, **{f: True for f in fields}},
+    )
+
+
+def sampleDocs(df, user_ids, fields):
+    return df[df["user_id"].isin(user_ids)][["user_id", *fields]].to_dict(
+        orient="records"
+    )
+
+
+class UserProfileLoader:
+    """
+    Loads UserProfile objects.
+
+    - Every query is filtered on user_id and projects only the fields it needs.
+    - The genre, artist and interaction lookups run concurrently on a small
+      thread pool, so this stage costs one round trip instead of three.
+    """
+
+    def __init__(
+        self,
+        user_fav_artist_collection,
+        user_fav_genre_collection,
+        user_song_interaction_collection,
+        use_sample_data,
+    ):
+        self.user_fav_artist_collection = user_fav_artist_collection
+        self.user_fav_genre_collection = user_fav_genre_collection
+        self.user_song_interaction_collection = user_song_interaction_collection
+        self.use_sample_data = use_sample_data
+        self.executor = ThreadPoolExecutor(
+            max_workers=3, thread_name_prefix="user-profile"
+        )
+
+    def findDocs(self, collection, user_ids, fields):
+        if self.use_sample_data == True:
+            return sampleDocs(collection, user_ids, fields)
+
+        query, projection = userQuery(user_ids, fields)
+        return list(collection.find(query, projection=projection))
+
+    def loadMany(self, user_ids):
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return dict()
+
+        genre_docs = self.executor.submit(
+            self.findDocs, self.user_fav_genre_collection, user_ids, ["fav_genres"]
+        )
+        artist_docs = self.executor.submit(
+            self.findDocs, self.user_fav_artist_collection, user_ids, ["fav_artist"]
+        )
+        liked_song_docs = self.executor.submit(
+            self.findDocs, self.user_song_interaction_collection, user_ids, ["song_id"]
+        )
+
+        return profilesFrom(
+            user_ids,
+            genre_docs.result(),
+            artist_docs.result(),
+            liked_song_docs.result(),
+        )
+
+    def load(self, user_id):
+        return self.loadMany([user_id])[user_id]
+
+
+class AsyncUserProfileLoader:
+    """Same as UserProfileLoader, on the async mongo driver with asyncio.gather instead of threads"""
+
+    def __init__(
+        self,
+        user_fav_artist_collection,
+        user_fav_genre_collection,
+        user_song_interaction_collection,
+        use_sample_data,
+    ):
+        self.user_fav_artist_collection = user_fav_artist_collection
+        self.user_fav_genre_collection = user_fav_genre_collection
+        self.user_song_interaction_collection = user_song_interaction_collection
+        self.use_sample_data = use_sample_data
+
+    async def findDocs(self, collection, user_ids, fields):
+        if self.use_sample_data == True:
+            return sampleDocs(collection, user_ids, fields)
+
+        query, projection = userQuery(user_ids, fields)
+        return await collection.find(query, projection=projection).to_list()
+
+    async def loadMany(self, user_ids):
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return dict()
+
+        genre_docs, artist_docs, liked_song_docs = await asyncio.gather(
+            self.findDocs(self.user_fav_genre_collection, user_ids, ["fav_genres"]),
+            self.findDocs(self.user_fav_artist_collection, user_ids, ["fav_artist"]),
+            self.findDocs(self.user_song_interaction_collection, user_ids, ["song_id"]),
+        )
+        return profilesFrom(user_ids, genre_docs, artist_docs, liked_song_docs)
+
+    async def load(self, user_id):
+        return (await self.loadMany([user_id]))[user_id]
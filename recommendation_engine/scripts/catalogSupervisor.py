@@ -0,0 +1,145 @@
+"""
+Here, I own the shared memory catalog: build it once, publish it for the uvicorn
+workers and rebuild it every SHARED_CATALOG_REFRESH seconds (or on SIGHUP).
+
+Run from recommendation_engine/:
+
+    python scripts/catalogSupervisor.py --workers 4
+
+With --workers, uvicorn is started as a child process with SHARED_CATALOG_DIR set,
+and the segments are removed when it exits.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from config import settings
+from database.db import MongoConnect
+from recommender.catalogStore import CatalogStore
+from recommender.sharedCatalog import SharedCatalogPublisher
+from recommender.trackDocs import loadTrackDocs
+
+DEFAULT_SHARED_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "shared"
+)
+
+
+def openCollections():
+    if settings.USE_SAMPLE_DATA == True:
+        return (
+            pd.read_json(settings.SAMPLE_EMBEDDINGS_PATH),
+            pd.read_json(settings.SAMPLE_TRACKS_PATH),
+        )
+
+    db = MongoConnect().connect(settings.MONGO_URI)["EchoFinder"]
+    return db["songs_embeddings"], db["trackdetails"]
+
+
+def buildCatalog(embeddings_collection, tracks_collection):
+    """Same sources as a worker: the sample data, or the snapshot plus later updates, or the collection"""
+    if settings.USE_SAMPLE_DATA == True:
+        catalog = CatalogStore.fromDataFrame(embeddings_collection)
+    else:
+        catalog = None
+        if settings.EMBEDDINGS_SNAPSHOT_DIR:
+            catalog = CatalogStore.fromSnapshot(settings.EMBEDDINGS_SNAPSHOT_DIR)
+
+        if catalog is None:
+            catalog = CatalogStore.fromCollection(embeddings_collection)
+        else:
+            catalog.applyUpdatesSince(embeddings_collection, catalog.updated_at)
+
+    track_docs = loadTrackDocs(tracks_collection, settings.USE_SAMPLE_DATA)
+    return catalog, track_docs
+
+
+def startWorkers(shared_dir, workers, host, port):
+    env = dict(os.environ, SHARED_CATALOG_DIR=shared_dir)
+    command = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "index:app",
+        "--host",
+        host,
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+    ]
+    print("starting workers: ", " ".join(command))
+    return subprocess.Popen(
+        command,
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish the catalog in shared memory")
+    parser.add_argument(
+        "--shared-dir", default=settings.SHARED_CATALOG_DIR or DEFAULT_SHARED_DIR
+    )
+    parser.add_argument(
+        "--refresh", type=float, default=settings.SHARED_CATALOG_REFRESH
+    )
+    parser.add_argument("--keep", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    embeddings_collection, tracks_collection = openCollections()
+    publisher = SharedCatalogPublisher(args.shared_dir, keep=args.keep)
+    publisher.publish(*buildCatalog(embeddings_collection, tracks_collection))
+
+    stop_event = threading.Event()
+    rebuild_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGHUP, lambda signum, frame: rebuild_event.set())
+
+    server = None
+    if args.workers > 0:
+        server = startWorkers(args.shared_dir, args.workers, args.host, args.port)
+
+    next_rebuild = time.monotonic() + args.refresh
+    try:
+        while not stop_event.is_set():
+            # wake up every second to notice SIGHUP, a stop and the workers exiting
+            rebuild = rebuild_event.wait(1.0)
+            if server is not None and server.poll() is not None:
+                print("workers exited with code: ", server.returncode)
+                break
+
+            if args.refresh > 0 and time.monotonic() >= next_rebuild:
+                rebuild = True
+            if rebuild:
+                next_rebuild = time.monotonic() + args.refresh
+                rebuild_event.clear()
+                try:
+                    publisher.publish(
+                        *buildCatalog(embeddings_collection, tracks_collection)
+                    )
+                except Exception as e:
+                    # the workers keep the version they have
+                    print("shared catalog rebuild failed: ", e)
+    finally:
+        if server is not None and server.poll() is None:
+            server.terminate()
+            server.wait()
+        publisher.close()
+        MongoConnect.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,116 @@
+"""
+Here, I save the embedding model the engine loads from EMBEDDINGS_MODEL.
+
+Run from recommendation_engine/:
+
+    python scripts/saveEmbeddingModel.py
+    python scripts/saveEmbeddingModel.py --quantize
+
+The first saves all-MiniLM-L6-v2 to rec_models/embeddingModel (fp32). With
+--quantize, the weights of an int8 dynamically quantized copy are also saved
+to rec_models/embeddingModel-int8.pt. The saved copy is loaded back and kept
+only if, on the sample track texts, every vector has a cosine of at least
+--min-cosine with the fp32 one; the throughput of both is printed. Point
+EMBEDDINGS_MODEL at the .pt file to serve it.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
 from sentence_transformers import SentenceTransformer
-import pickle
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+from database.embeddingModel import (
+    compareModels,
+    loadEmbeddingModel,
+    quantizeModel,
+    saveQuantizedModel,
+)
+
+ENGINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def trackText(track):
+    """The same text EmbeddingsOps encodes for a track"""
+    artists = track.get("artists")
+    if isinstance(artists, list):
+        artists = ",".join(a["name"] for a in artists if a.get("name"))
+    return (
+        "Title: "
+        + str(track.get("title"))
+        + " | Artists: "
+        + str(artists)
+        + " | Album: "
+        + str(track.get("release"))
+        + " | Tags: "
+        + str(track.get("all_tags"))
+        + " | Wiki_Summary: "
+        + str(track.get("wiki_summary"))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Save the embedding model")
+    parser.add_argument("--source", default="all-MiniLM-L6-v2")
+    parser.add_argument(
+        "--output", default=os.path.join(ENGINE_DIR, "rec_models", "embeddingModel")
+    )
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument(
+        "--quantized-output",
+        default=os.path.join(ENGINE_DIR, "rec_models", "embeddingModel-int8.pt"),
+    )
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument(
+        "--texts",
+        default=os.path.join(
+            ENGINE_DIR, "data", "processed", "EchoFinder.trackdetails.json"
+        ),
+    )
+    parser.add_argument("--sample-size", type=int, default=512)
+    args = parser.parse_args()
+
+    model = SentenceTransformer(args.source, device="cpu")
+
+    # for cpu machine
+    if args.output:
+        model.save(args.output)
+        print("fp32 model saved to ", args.output)
+
+    if not args.quantize:
+        return
+
+    # the quantized layers are rebuilt from a saved fp32 directory at load time
+    base_dir = args.output or args.source
+    if not os.path.isdir(base_dir):
+        print("--quantize needs --output or a saved model directory as --source")
+        sys.exit(1)
+
+    # quantize_dynamic works on a copy, model stays fp32
+    saveQuantizedModel(quantizeModel(model), base_dir, args.quantized_output)
+
+    # checks the file the engine will load, not the in-memory copy
+    quantized = loadEmbeddingModel(args.quantized_output)
+    tracks = pd.read_json(args.texts).head(args.sample_size)
+    texts = [trackText(track) for track in tracks.to_dict(orient="records")]
+    report = compareModels(model, quantized, texts)
+    print("int8 against fp32: ", report)
+
+    if report["min_cosine"] < args.min_cosine:
+        os.remove(args.quantized_output)
+        print(
+            "int8 model removed: min cosine ",
+            report["min_cosine"],
+            " is below ",
+            args.min_cosine,
+        )
+        sys.exit(1)
+
+    print("int8 model saved to ", args.quantized_output)
 
-# for gpu  machine
-# with open("../models/embeddingModel.pkl", "wb") as f:
-#     pickle.dump(model, f)
 
-# for cpu machine
-model.save("../rec_models/embeddingModel")
+if __name__ == "__main__":
+    main()